@@ -0,0 +1,97 @@
+import json
+
+from os import path
+from os import remove
+from os import replace
+from tempfile import mkstemp
+from abc import ABC, abstractmethod
+
+
+class NluBackend(ABC):
+    """
+    Storage of NLU training examples.
+
+    Edits are dicts with op (add, update or remove), text and intent. The
+    GroupCommitWriter calls apply on the event loop and append in a thread,
+    a backend does its work in whichever of the two suits it.
+
+    generation changes whenever the examples are reloaded from outside the
+    app, anything derived from them has to be rebuilt then.
+    """
+
+    generation = 0
+
+    @abstractmethod
+    def intent_names(self):
+        """
+        Set of every intent that has examples.
+        """
+
+    @abstractmethod
+    def get(self, text):
+        """
+        Intent of a text, or None.
+        """
+
+    @abstractmethod
+    def page(self, page=1, page_size=50, intent=None, q=None):
+        """
+        One page of examples in text order, optionally of one intent and matching q.
+
+        :return: List of (text, intent) on the page and the number of matches.
+        """
+
+    @abstractmethod
+    def iter_examples(self):
+        """
+        Yield every example as a Rasa example dict.
+        """
+
+    def apply(self, entries):
+        pass
+
+    @abstractmethod
+    def append(self, entries):
+        """
+        Make edits durable, one call per batch of edits.
+        """
+
+    def write(self, entries):
+        self.apply(entries)
+        self.append(entries)
+
+    def read(self):
+        """
+        text -> intent of every example and the set of intents.
+        """
+        text_intent = {example['text']: example['intent'] for example in self.iter_examples()}
+        return text_intent, set(text_intent.values())
+
+    def export_chunks(self):
+        """
+        Rasa JSON training data as text chunks, one per example.
+        """
+        yield '{\n    "rasa_nlu_data": {\n        "common_examples": ['
+        separator = "\n"
+        for example in self.iter_examples():
+            yield separator + "            " + json.dumps(example, ensure_ascii=False)
+            separator = ",\n"
+        yield "\n        ]\n    }\n}\n"
+
+    def export(self, file_path):
+        """
+        Write every example to a Rasa JSON training file, one example at a time.
+
+        The data goes to a temp file of its own next to file_path first, so
+        concurrent exports never write into the same file.
+        """
+        fd, temp_path = mkstemp(dir=path.dirname(file_path) or ".", suffix=".tmp")
+        try:
+            with open(fd, 'w', encoding="utf-8") as f:
+                for chunk in self.export_chunks():
+                    f.write(chunk)
+            replace(temp_path, file_path)
+        except BaseException:
+            remove(temp_path)
+            raise
+        return file_path
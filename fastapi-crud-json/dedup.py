@@ -0,0 +1,284 @@
+import re
+import asyncio
+
+from hashlib import blake2b
+from random import Random
+from threading import RLock
+
+# MinHash permutations, split into BANDS bands of NUM_PERM // BANDS rows for LSH
+NUM_PERM = 32
+BANDS = 8
+
+# Trigram Jaccard similarity from which two texts count as near duplicates
+THRESHOLD = 0.7
+
+# Largest prime below 2 ** 30, hashes stay small ints that compare fast
+PRIME = (1 << 30) - 35
+
+NON_WORD = re.compile(r"[\W_]+")
+
+
+# Lower case words separated by single spaces, texts equal after this are exact duplicates
+def normalize(text):
+    return NON_WORD.sub(" ", text.lower()).strip()
+
+
+def trigrams(normalized):
+    padded = f" {normalized} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class DuplicateIndex:
+    """
+    Finds exact and near duplicate example texts.
+
+    Exact duplicates are texts equal once normalized (case, punctuation and
+    spacing ignored), looked up in a dict. Near duplicates share most of their
+    character trigrams: every text gets a MinHash signature, cut into bands,
+    and texts sharing a band land in the same LSH bucket. Only texts of the
+    buckets of a query are compared, so a lookup costs about the same whatever
+    the size of the corpus. Adding and removing a text updates the index in
+    place.
+
+    :param num_perm: Length of the MinHash signatures.
+    :param bands: Number of LSH bands, more bands find less similar texts.
+    :param threshold: Trigram Jaccard similarity reported as a near duplicate.
+    """
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, threshold=THRESHOLD):
+        self.rows = num_perm // bands
+        self.bands = bands
+        self.threshold = threshold
+        random = Random(1)
+        self.permutations = [(random.randrange(1, PRIME), random.randrange(PRIME)) for _ in range(num_perm)]
+        self.lock = RLock()
+        self.text_intent = {}
+        self.shingles = {}
+        self.signatures = {}
+        self.exact = {}
+        self.buckets = {}
+        # Permuted hashes of every trigram seen, signatures are column minimums of these
+        self.trigram_hashes = {}
+        self.generation = None
+
+    def build(self, examples):
+        with self.lock:
+            for example in examples:
+                self.add(example['text'], example['intent'])
+        return self
+
+    @classmethod
+    def from_store(cls, store):
+        """
+        A new index of every example of an NluBackend.
+        """
+        index = cls()
+        # The store loads its examples while they are read, so its generation is read afterwards
+        index.build(store.iter_examples())
+        index.generation = store.generation
+        return index
+
+    def _hashes(self, trigram):
+        hashes = self.trigram_hashes.get(trigram)
+        if hashes is None:
+            value = int.from_bytes(blake2b(trigram.encode(), digest_size=4).digest(), "big")
+            hashes = self.trigram_hashes[trigram] = tuple((a * value + b) % PRIME for a, b in self.permutations)
+        return hashes
+
+    def _signature(self, shingles):
+        if not shingles:
+            return ()
+        return tuple(map(min, zip(*(self._hashes(trigram) for trigram in shingles))))
+
+    def _bands(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def add(self, text, intent):
+        with self.lock:
+            if text in self.text_intent:
+                self.text_intent[text] = intent
+                return
+            normalized = normalize(text)
+            shingles = trigrams(normalized)
+            signature = self._signature(shingles)
+            self.text_intent[text] = intent
+            self.shingles[text] = shingles
+            self.signatures[text] = signature
+            self.exact.setdefault(normalized, set()).add(text)
+            if signature:
+                for key in self._bands(signature):
+                    self.buckets.setdefault(key, set()).add(text)
+
+    def remove(self, text):
+        with self.lock:
+            if self.text_intent.pop(text, None) is None:
+                return
+            self.shingles.pop(text)
+            signature = self.signatures.pop(text)
+            normalized = normalize(text)
+            texts = self.exact[normalized]
+            texts.discard(text)
+            if not texts:
+                del self.exact[normalized]
+            if signature:
+                for key in self._bands(signature):
+                    bucket = self.buckets[key]
+                    bucket.discard(text)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def apply(self, entries):
+        """
+        Follow edits of the store, the dicts a GroupCommitWriter commits.
+        """
+        with self.lock:
+            for entry in entries:
+                if entry['op'] == 'add':
+                    self.add(entry['text'], entry['intent'])
+                elif entry['op'] == 'update':
+                    if entry['text'] in self.text_intent:
+                        self.text_intent[entry['text']] = entry['intent']
+                elif entry['op'] == 'remove':
+                    self.remove(entry['text'])
+
+    def find(self, text, limit=10):
+        """
+        Texts of the index that duplicate text, most similar first.
+
+        :return: List of dicts with text, intent, similarity and exact.
+        """
+        with self.lock:
+            normalized = normalize(text)
+            exact = self.exact.get(normalized, set())
+            shingles = trigrams(normalized)
+            candidates = set(exact)
+            signature = self._signature(shingles)
+            if signature:
+                for key in self._bands(signature):
+                    candidates.update(self.buckets.get(key, ()))
+            matches = []
+            for candidate in candidates:
+                if candidate in exact:
+                    similarity = 1.0
+                else:
+                    similarity = _jaccard(shingles, self.shingles[candidate])
+                    if similarity < self.threshold:
+                        continue
+                matches.append({"text": candidate, "intent": self.text_intent[candidate],
+                                "similarity": round(similarity, 3), "exact": candidate in exact})
+            matches.sort(key=lambda match: (-match["similarity"], match["text"]))
+            return matches[:limit]
+
+    def report(self):
+        """
+        Every group of duplicate texts in the index.
+
+        Pairs come from the LSH buckets and are checked against the
+        threshold, groups are the connected texts. A group whose texts have
+        different intents is a labelling conflict.
+
+        :return: List of groups, dicts with texts (text -> intent), exact and conflict.
+        """
+        # Only the groups of texts are copied under the lock, the comparisons run on the copy
+        with self.lock:
+            text_intent = dict(self.text_intent)
+            shingles = dict(self.shingles)
+            exact_groups = [tuple(texts) for texts in self.exact.values() if len(texts) > 1]
+            buckets = [tuple(bucket) for bucket in self.buckets.values() if len(bucket) > 1]
+
+        parent = {}
+
+        def find_root(text):
+            while parent[text] != text:
+                parent[text] = parent[parent[text]]
+                text = parent[text]
+            return text
+
+        def union(first, second):
+            parent.setdefault(first, first)
+            parent.setdefault(second, second)
+            first, second = find_root(first), find_root(second)
+            if first != second:
+                parent[max(first, second)] = min(first, second)
+
+        for texts in exact_groups:
+            first, *others = sorted(texts)
+            for other in others:
+                union(first, other)
+
+        for bucket in buckets:
+            bucket = sorted(bucket)
+            for i, first in enumerate(bucket):
+                for second in bucket[i + 1:]:
+                    # Texts already grouped need no comparison
+                    if first in parent and second in parent and find_root(first) == find_root(second):
+                        continue
+                    if _jaccard(shingles[first], shingles[second]) >= self.threshold:
+                        union(first, second)
+
+        groups = {}
+        for text in parent:
+            groups.setdefault(find_root(text), set()).add(text)
+        report = []
+        for texts in groups.values():
+            texts = sorted(texts)
+            intents = {text_intent[text] for text in texts}
+            report.append({
+                "texts": {text: text_intent[text] for text in texts},
+                "exact": len({normalize(text) for text in texts}) == 1,
+                "conflict": len(intents) > 1,
+            })
+        report.sort(key=lambda group: (not group["conflict"], -len(group["texts"])))
+        return report
+
+    def stats(self):
+        return {"texts": len(self.text_intent), "buckets": len(self.buckets), "trigrams": len(self.trigram_hashes)}
+
+
+class DuplicateTracker:
+    """
+    The DuplicateIndex of a store, kept current from the event loop.
+
+    Edits committed by the writer are applied to the index as they happen.
+    When the store reloads from disk a new index is built in a thread while
+    lookups keep using the old one; requests arriving meanwhile wait for that
+    one build instead of starting their own. Edits committed during the
+    build are replayed on the new index before it is swapped in.
+
+    :param store: NluBackend the examples come from.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.index = DuplicateIndex()
+        self.rebuilding = None
+        self.pending = None
+
+    def apply(self, entries):
+        self.index.apply(entries)
+        if self.pending is not None:
+            self.pending.extend(entries)
+
+    async def current(self):
+        if self.index.generation != self.store.generation:
+            if self.rebuilding is None:
+                self.rebuilding = asyncio.create_task(self._rebuild())
+            # A cancelled request must not cancel the build the others wait for
+            await asyncio.shield(self.rebuilding)
+        return self.index
+
+    async def _rebuild(self):
+        self.pending = []
+        try:
+            index = await asyncio.to_thread(DuplicateIndex.from_store, self.store)
+            index.apply(self.pending)
+            self.index = index
+        finally:
+            self.pending = None
+            self.rebuilding = None
+
+
+def _jaccard(first, second):
+    if not first and not second:
+        return 1.0
+    return len(first & second) / len(first | second)
@@ -1,13 +1,17 @@
 import os
+import asyncio
 import datetime
 
-from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from time import perf_counter
+
+from fastapi import FastAPI, Request, Form, HTTPException, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette import status
 
-from util import read_json, add_json, remove_json, update_json
+from store import store, writer
+from dedup import DuplicateTracker
 
 app = FastAPI()
 
@@ -16,19 +20,91 @@ app.mount("/static", StaticFiles(directory="./static"), name="static")
 templates = Jinja2Templates(directory="./templates")
 
 
+@app.on_event("startup")
+async def start_writer():
+    writer.start()
+    writer.listeners.append(duplicates.apply)
+
+
+@app.on_event("shutdown")
+async def stop_writer():
+    await writer.stop()
+
+
+# Largest page_size accepted by the listing endpoints
+MAX_PAGE_SIZE = 500
+
+
+def page_of_examples(page, page_size, intent, q):
+    items, total = store.page(page, page_size, intent or None, q)
+    return {
+        "page": page,
+        "page_size": page_size,
+        "total": total,
+        "pages": max((total + page_size - 1) // page_size, 1),
+        "intent": intent,
+        "q": q,
+        "items": items,
+    }
+
+
+def render_home(request, page=1, page_size=50, intent="", q="", **context):
+    intents = store.intent_names()
+    result = page_of_examples(page, page_size, intent, q)
+    return templates.TemplateResponse('index.html', {"request": request, "nlu_data": dict(result["items"]),
+                                                     "intends": intents, "paging": result, **context})
+
+
 # deserialize data
 @app.get('/', response_class=HTMLResponse)
-async def backend_ui_home(request: Request):
-    text, intent =  read_json()
-    return templates.TemplateResponse('index.html', {"request": request,"nlu_data" : text, "intends": intent})
+async def backend_ui_home(request: Request, page: int = Query(1, ge=1),
+                          page_size: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                          intent: str = "", q: str = ""):
+    return render_home(request, page, page_size, intent, q)
+
+
+@app.get('/api/examples')
+async def api_examples(page: int = Query(1, ge=1), page_size: int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+                       intent: str = "", q: str = ""):
+    result = page_of_examples(page, page_size, intent, q)
+    result["items"] = [{"text": text, "intent": intent} for text, intent in result["items"]]
+    return result
+
+
+# Index of the example texts, rebuilt when the store reloads and kept up to date by the writer
+duplicates = DuplicateTracker(store)
 
 
 @app.post("/add", response_class=HTMLResponse)
-async def admin_model_config(sentence=Form(), intent=Form()):
-    add_json(sentence, intent)
+async def admin_model_config(request: Request, sentence=Form(), intent=Form(), force: bool = Form(False)):
+    index = await duplicates.current()
+    matches = index.find(sentence)
+    wants_json = "application/json" in request.headers.get("accept", "")
+    if matches and not force:
+        # Nothing is saved until the sentence is sent again with force
+        if wants_json:
+            return JSONResponse({"added": False, "duplicates": matches}, status_code=status.HTTP_409_CONFLICT)
+        return render_home(request, duplicates=matches, pending={"sentence": sentence, "intent": intent})
+    await writer.add(sentence, intent)
+    if wants_json:
+        return JSONResponse({"added": True, "duplicates": matches})
     return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
 
 
+@app.get("/duplicates")
+async def duplicate_report():
+    index = await duplicates.current()
+    started = perf_counter()
+    groups = await asyncio.to_thread(index.report)
+    return {
+        "groups": len(groups),
+        "conflicts": sum(group["conflict"] for group in groups),
+        "time": round(perf_counter() - started, 3),
+        "index": index.stats(),
+        "report": groups,
+    }
+
+
 @app.post("/delete")
 def delete(sentence=Form(), intent: str = Form(default="")):
     print(intent,sentence,'nil')
@@ -42,5 +118,17 @@ async def admin_nlu_update(request: Request):
 
     s = request_data_json['sentence']
     i = request_data_json['intent']
-    update_json(s, i)
+    await writer.update(s, i)
     return {"ok": "done"}
+
+
+# Rasa training file streamed from the store on request
+@app.get("/export")
+def export_rasa():
+    return StreamingResponse(store.export_chunks(), media_type="application/json",
+                             headers={"Content-Disposition": 'attachment; filename="nlu.json"'})
+
+
+@app.get("/writer")
+async def writer_stats():
+    return writer.stats()
@@ -0,0 +1,478 @@
+import re
+import json
+import asyncio
+
+from bisect import bisect_left
+from bisect import insort
+
+from os import fsync
+from os import getenv
+from os import path
+from os import replace
+from os import stat
+from time import monotonic
+from threading import RLock
+
+from backend import NluBackend
+
+NLU_FILE = 'static/test.json'
+
+# Storage of the examples: json (the training file) or sqlite
+NLU_BACKEND = getenv("NLU_BACKEND", "json")
+
+# Seconds between two checks of the files for changes made outside the app
+CHECK_INTERVAL = 1.0
+
+# Journal entries after which the training file is rewritten and the journal emptied
+COMPACT_THRESHOLD = 500
+
+# Most edits committed together by the writer
+MAX_BATCH = 256
+
+WORD = re.compile(r"\w+")
+
+
+# Lower case words of a text, the keys of the search index
+def text_words(text):
+    return set(WORD.findall(text.lower()))
+
+
+class NluStore(NluBackend):
+    """
+    The NLU training file loaded once and kept indexed in memory.
+
+    Edits are applied to the indexes and appended to an NDJSON journal next
+    to the training file (test.json.journal), one short line per edit. Loading
+    replays the journal over the file, and once the journal holds
+    compact_threshold entries the file is rewritten atomically and the journal
+    emptied. The files are parsed again only when they change on disk, reads in
+    between are dict lookups.
+
+    examples: text -> list of examples with that text (the file may repeat a text)
+    text_intent: text -> intent, the last example with that text wins
+    intents: intent -> dict of its texts, used as an ordered set
+
+    Paging and search use sorted indexes, built on the first search after a
+    load and kept up to date by every edit:
+    sorted_texts: sorted (lower case text, text) of every text
+    intent_texts: intent -> sorted (lower case text, text) of its texts
+    word_index: sorted (word, text) for every word of every text
+    """
+
+    def __init__(self, file_path=NLU_FILE, check_interval=CHECK_INTERVAL, compact_threshold=COMPACT_THRESHOLD):
+        self.file_path = file_path
+        self.journal_path = f"{file_path}.journal"
+        self.check_interval = check_interval
+        self.compact_threshold = compact_threshold
+        self.document = None
+        self.examples = {}
+        self.text_intent = {}
+        self.intents = {}
+        self.journal_entries = 0
+        # Sequence number of the last journaled edit
+        self.seq = 0
+        self.signature = None
+        self.checked = 0.0
+        self.lock = RLock()
+        # Serializes journal writes and compactions, which run without holding lock
+        self.io_lock = RLock()
+        self.writing = False
+        self.sorted_texts = []
+        self.intent_texts = {}
+        self.word_index = []
+        self.search_ready = False
+
+    def _signature(self):
+        info = stat(self.file_path)
+        journal_size = path.getsize(self.journal_path) if path.exists(self.journal_path) else 0
+        return info.st_mtime_ns, info.st_size, journal_size
+
+    def invalidate(self):
+        # The next read checks the files again
+        self.checked = 0.0
+
+    def refresh(self):
+        """
+        Load the files when they are new or changed, at most once per check_interval.
+        """
+        now = monotonic()
+        if self.document is not None and now - self.checked < self.check_interval:
+            return
+        if self.writing:
+            # The files change under our own write, they are checked once it is done
+            return
+        with self.lock:
+            signature = self._signature()
+            self.checked = now
+            if signature != self.signature:
+                self.load()
+
+    def load(self):
+        with self.lock:
+            with open(self.file_path, 'r', encoding="utf-8-sig") as f:
+                document = json.load(f)
+            self.document = document
+            self.generation += 1
+            self.examples, self.text_intent, self.intents = {}, {}, {}
+            self.search_ready = False
+            for example in document['rasa_nlu_data']['common_examples']:
+                self._index(example)
+
+            self.journal_entries = 0
+            # Edits up to journal_seq are already in the file, a crash after compacting left them in the journal
+            snapshot_seq = document.get('journal_seq', 0)
+            self.seq = snapshot_seq
+            if path.exists(self.journal_path):
+                with open(self.journal_path, 'r', encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            break  # Last line cut short by a crash
+                        self.journal_entries += 1
+                        if entry['seq'] <= snapshot_seq:
+                            continue
+                        self.seq = entry['seq']
+                        self._apply(entry)
+            self.signature = self._signature()
+
+    def _index(self, example):
+        text = example['text']
+        if self.search_ready:
+            self._search_index(text, example['intent'])
+        self.examples.setdefault(text, []).append(example)
+        self.text_intent[text] = example['intent']
+        self.intents.setdefault(example['intent'], {})[text] = None
+
+    def _unindex(self, text):
+        if self.search_ready and text in self.text_intent:
+            self._search_unindex(text)
+        for example in self.examples.pop(text, ()):
+            texts = self.intents.get(example['intent'], {})
+            texts.pop(text, None)
+            if not texts:
+                self.intents.pop(example['intent'], None)
+        self.text_intent.pop(text, None)
+
+    def _build_search(self):
+        # Sorting once is far cheaper than inserting every text of a big file one by one
+        self.sorted_texts = sorted((text.lower(), text) for text in self.text_intent)
+        self.intent_texts = {}
+        for key in self.sorted_texts:
+            self.intent_texts.setdefault(self.text_intent[key[1]], []).append(key)
+        self.word_index = sorted((word, text) for text in self.text_intent for word in text_words(text))
+        self.search_ready = True
+
+    def _search_index(self, text, intent):
+        key = (text.lower(), text)
+        old_intent = self.text_intent.get(text)
+        if old_intent is None:
+            insort(self.sorted_texts, key)
+            for word in text_words(text):
+                insort(self.word_index, (word, text))
+        elif old_intent != intent:
+            _sorted_remove(self.intent_texts.get(old_intent, []), key)
+        if old_intent != intent:
+            insort(self.intent_texts.setdefault(intent, []), key)
+
+    def _search_unindex(self, text):
+        key = (text.lower(), text)
+        _sorted_remove(self.sorted_texts, key)
+        _sorted_remove(self.intent_texts.get(self.text_intent[text], []), key)
+        for word in text_words(text):
+            _sorted_remove(self.word_index, (word, text))
+
+    def page(self, page=1, page_size=50, intent=None, q=None):
+        """
+        One page of examples in text order, optionally of one intent and matching q.
+
+        q matches texts that contain it, starting at a word. Without q a page
+        is a slice of a sorted index; with q only texts having a word that
+        starts like q are looked at.
+
+        :return: List of (text, intent) on the page and the number of matches.
+        """
+        self.refresh()
+        with self.lock:
+            if not self.search_ready:
+                self._build_search()
+            offset = (page - 1) * page_size
+            q = (q or "").strip().lower()
+            if not q:
+                keys = self.intent_texts.get(intent, []) if intent else self.sorted_texts
+                return [(text, self.text_intent[text]) for _, text in keys[offset:offset + page_size]], len(keys)
+
+            words = WORD.findall(q)
+            if not words:
+                return [], 0
+            first = words[0]
+            start = bisect_left(self.word_index, (first,))
+            matches = {}
+            for word, text in self.word_index[start:]:
+                if not word.startswith(first):
+                    break
+                if text in matches or (intent and self.text_intent[text] != intent):
+                    continue
+                lower = text.lower()
+                if q in lower:
+                    matches[text] = lower
+            ordered = sorted(matches, key=lambda text: (matches[text], text))
+            return [(text, self.text_intent[text]) for text in ordered[offset:offset + page_size]], len(ordered)
+
+    def _apply(self, entry):
+        text = entry['text']
+        if entry['op'] == 'add':
+            self._index({"text": text, "intent": entry['intent'], "entities": entry.get('entities', [])})
+        elif entry['op'] == 'update':
+            examples = self.examples.get(text)
+            if not examples:
+                return
+            self._unindex(text)
+            for example in examples:
+                example['intent'] = entry['intent']
+                self._index(example)
+        elif entry['op'] == 'remove':
+            self._unindex(text)
+
+    def write(self, entries):
+        """
+        Apply edits in memory and append them to the journal with one write.
+
+        :param entries: dicts with op (add, update or remove), text and intent.
+        """
+        # Edits reach the journal in the order they were applied
+        with self.io_lock:
+            self.apply(entries)
+            self.append(entries)
+
+    def apply(self, entries):
+        with self.lock:
+            self.refresh()
+            for entry in entries:
+                self._apply(entry)
+
+    def append(self, entries):
+        """
+        Append applied edits to the journal with one write and fsync, compacting past the threshold.
+
+        Only numbering the edits and counting them takes lock, readers are
+        never held up by the disk.
+        """
+        with self.io_lock:
+            with self.lock:
+                first_seq = self.seq + 1
+                # Numbers of a failed write are never reused, load only compares them to journal_seq
+                self.seq += len(entries)
+                self.writing = True
+            try:
+                lines = "".join(json.dumps(dict(entry, seq=seq), ensure_ascii=False) + "\n"
+                                for seq, entry in enumerate(entries, first_seq))
+                with open(self.journal_path, 'a', encoding="utf-8") as f:
+                    f.write(lines)
+                    f.flush()
+                    fsync(f.fileno())
+                with self.lock:
+                    self.journal_entries += len(entries)
+                    compact = self.journal_entries >= self.compact_threshold
+                if compact:
+                    self.compact()
+                else:
+                    with self.lock:
+                        self.signature = self._signature()
+            except OSError:
+                # Memory is ahead of the disk now, the next read loads the files again
+                with self.lock:
+                    self.signature = None
+                    self.invalidate()
+                raise
+            finally:
+                self.writing = False
+
+    def compact(self):
+        """
+        Rewrite the training file from memory and empty the journal.
+
+        The examples are copied under lock and written without it. The file is
+        written next to the old one and swapped in with os.replace, so a reader
+        or a crash never sees half a file. It records the sequence number of the
+        last edit it holds (journal_seq), so edits a crash left in the journal
+        are not replayed twice.
+        """
+        with self.io_lock:
+            with self.lock:
+                # Copies, an update changes the intent of the live examples in place
+                examples = [dict(example) for examples in self.examples.values() for example in examples]
+                document = dict(self.document, journal_seq=self.seq,
+                                rasa_nlu_data=dict(self.document['rasa_nlu_data'], common_examples=examples))
+            temp_path = f"{self.file_path}.tmp"
+            with open(temp_path, 'w', encoding="utf-8") as f:
+                json.dump(document, f, indent=4)
+                f.flush()
+                fsync(f.fileno())
+            replace(temp_path, self.file_path)
+            # A crash before this point leaves edits the new file already holds, load skips them by seq
+            # Appends wait for io_lock, so the journal holds nothing newer than the copy
+            open(self.journal_path, 'w').close()
+            with self.lock:
+                # Only the fields around the examples are kept, the examples live in the indexes
+                document['rasa_nlu_data'] = dict(document['rasa_nlu_data'], common_examples=[])
+                self.document = document
+                self.journal_entries = 0
+                self.signature = self._signature()
+
+    def get(self, text):
+        self.refresh()
+        return self.text_intent.get(text)
+
+    def intent_names(self):
+        self.refresh()
+        return set(self.intents)
+
+    def read(self):
+        self.refresh()
+        return self.text_intent, set(self.intents)
+
+    def iter_examples(self):
+        self.refresh()
+        with self.lock:
+            examples = [example for examples in self.examples.values() for example in examples]
+        yield from examples
+
+    def texts(self, intent):
+        self.refresh()
+        return list(self.intents.get(intent, ()))
+
+
+def _sorted_remove(items, key):
+    index = bisect_left(items, key)
+    if index < len(items) and items[index] == key:
+        del items[index]
+
+
+# Edits the store understands, checked before they are queued
+EDIT_FIELDS = {"add": ("text", "intent"), "update": ("text", "intent"), "remove": ("text",)}
+
+
+def check_entry(entry):
+    fields = EDIT_FIELDS.get(entry.get('op'))
+    if fields is None:
+        raise ValueError(f"Unknown edit {entry.get('op')!r}")
+    for field in fields:
+        if not isinstance(entry.get(field), str):
+            raise ValueError(f"{entry['op']} needs a string {field}")
+
+
+# Settle the future of a queued edit, unless its caller went away
+def _resolve(future, error=None):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
+
+
+class GroupCommitWriter:
+    """
+    Single writer task that commits concurrent edits in batches.
+
+    Requests put their edit on a queue and wait. The writer takes every edit
+    waiting at that moment (up to max_batch), applies them to the store on the
+    event loop and appends them to the journal with one write and fsync in a
+    thread, so a burst of edits costs one disk write instead of one each and no
+    edit overwrites another.
+
+    :param store: NluBackend the edits are applied to.
+    :param max_batch: Most edits committed together.
+    """
+
+    def __init__(self, store, max_batch=MAX_BATCH):
+        self.store = store
+        self.max_batch = max_batch
+        self.queue = None
+        self.task = None
+        self.batches = 0
+        self.edits = 0
+        # Called with the edits of every committed batch
+        self.listeners = []
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Waits for the queued edits to be written first
+        await self.queue.join()
+        self.task.cancel()
+
+    async def submit(self, entry):
+        check_entry(entry)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((entry, future))
+        await future
+
+    async def add(self, text, intent):
+        await self.submit({"op": "add", "text": text, "intent": intent, "entities": []})
+
+    async def update(self, text, intent):
+        await self.submit({"op": "update", "text": text, "intent": intent})
+
+    async def remove(self, text):
+        await self.submit({"op": "remove", "text": text})
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                # An edit that fails to apply fails alone, the rest of the batch is still committed
+                applied = []
+                for entry, future in batch:
+                    try:
+                        self.store.apply([entry])
+                    except Exception as e:
+                        _resolve(future, e)
+                    else:
+                        applied.append((entry, future))
+                if not applied:
+                    continue
+                entries = [entry for entry, _ in applied]
+                try:
+                    await asyncio.to_thread(self.store.append, entries)
+                except Exception as e:
+                    for _, future in applied:
+                        _resolve(future, e)
+                    continue
+                self.batches += 1
+                self.edits += len(applied)
+                for listener in self.listeners:
+                    try:
+                        listener(entries)
+                    except Exception as e:
+                        print("Writer listener failed:", e)
+                for _, future in applied:
+                    _resolve(future)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "edits": self.edits,
+            "edits_per_batch": round(self.edits / self.batches, 2) if self.batches else 0.0,
+            "queued": self.queue.qsize() if self.queue else 0,
+        }
+
+
+def make_store(backend=NLU_BACKEND):
+    if backend == "sqlite":
+        # Imported here, the JSON backend needs nothing of it
+        from sqlite_store import SqliteStore
+        return SqliteStore(import_path=NLU_FILE)
+    return NluStore()
+
+
+store = make_store()
+writer = GroupCommitWriter(store)
@@ -0,0 +1,124 @@
+import json
+
+import pytest
+
+from store import NluStore
+
+
+def make_store(tmp_path, examples=(), compact_threshold=100):
+    file_path = tmp_path / "test.json"
+    file_path.write_text(json.dumps({"rasa_nlu_data": {"common_examples": [
+        {"text": text, "intent": intent, "entities": []} for text, intent in examples
+    ]}}), encoding="utf-8")
+    store = NluStore(str(file_path), check_interval=0, compact_threshold=compact_threshold)
+    store.load()
+    return store
+
+
+def reopen(store):
+    # A fresh store on the same files, as after a restart
+    reopened = NluStore(store.file_path, check_interval=0, compact_threshold=store.compact_threshold)
+    reopened.load()
+    return reopened
+
+
+def journal_lines(store):
+    with open(store.journal_path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_load_replays_the_journal(tmp_path):
+    store = make_store(tmp_path, [("hello", "greet"), ("bye", "goodbye")])
+    store.write([{"op": "add", "text": "hi", "intent": "greet", "entities": []}])
+    store.write([{"op": "update", "text": "bye", "intent": "farewell"}])
+    store.write([{"op": "remove", "text": "hello"}])
+
+    reopened = reopen(store)
+    assert reopened.read() == ({"hi": "greet", "bye": "farewell"}, {"greet", "farewell"})
+    assert reopened.seq == 3
+    assert [entry['seq'] for entry in journal_lines(store)] == [1, 2, 3]
+
+
+def test_load_ignores_a_line_cut_short(tmp_path):
+    store = make_store(tmp_path)
+    store.write([{"op": "add", "text": "hi", "intent": "greet", "entities": []}])
+    with open(store.journal_path, 'a', encoding="utf-8") as f:
+        f.write('{"op": "add", "text": "lost"')
+
+    reopened = reopen(store)
+    assert reopened.get("hi") == "greet"
+    assert reopened.get("lost") is None
+
+
+def test_compact_rewrites_the_file_and_empties_the_journal(tmp_path):
+    store = make_store(tmp_path, [("hello", "greet")], compact_threshold=2)
+    store.write([{"op": "add", "text": "hi", "intent": "greet", "entities": []}])
+    store.write([{"op": "update", "text": "hello", "intent": "welcome"}])
+
+    assert journal_lines(store) == []
+    with open(store.file_path, encoding="utf-8") as f:
+        document = json.load(f)
+    assert document['journal_seq'] == 2
+    assert {example['text']: example['intent'] for example in document['rasa_nlu_data']['common_examples']} == \
+        {"hello": "welcome", "hi": "greet"}
+
+    # Numbering goes on after the compaction, a reload sees every edit once
+    store.write([{"op": "add", "text": "hey", "intent": "greet", "entities": []}])
+    assert [entry['seq'] for entry in journal_lines(store)] == [3]
+    reopened = reopen(store)
+    assert reopened.read()[0] == {"hello": "welcome", "hi": "greet", "hey": "greet"}
+    assert reopened.seq == 3
+
+
+def test_journal_left_by_a_crash_after_compacting_is_not_replayed(tmp_path):
+    store = make_store(tmp_path, compact_threshold=2)
+    store.write([{"op": "add", "text": "a", "intent": "x", "entities": []}])
+    lines = open(store.journal_path, encoding="utf-8").read()
+    store.write([{"op": "update", "text": "a", "intent": "y"}])
+    lines += json.dumps({"op": "update", "text": "a", "intent": "y", "seq": 2}) + "\n"
+    # The file holds both edits, the journal was never emptied
+    with open(store.journal_path, 'w', encoding="utf-8") as f:
+        f.write(lines)
+
+    reopened = reopen(store)
+    assert reopened.examples["a"] == [{"text": "a", "intent": "y", "entities": []}]
+    assert reopened.seq == 2
+
+
+def test_forced_duplicate_add_is_stored(tmp_path):
+    store = make_store(tmp_path, [("hello", "greet")])
+    store.write([{"op": "add", "text": "hello", "intent": "greet", "entities": []}])
+
+    assert len(store.examples["hello"]) == 2
+    assert len(reopen(store).examples["hello"]) == 2
+
+
+def test_refresh_loads_changes_made_outside_the_app(tmp_path):
+    store = make_store(tmp_path, [("hello", "greet")])
+    generation = store.generation
+    other = reopen(store)
+    other.write([{"op": "add", "text": "hi", "intent": "greet", "entities": []}])
+
+    assert store.get("hi") == "greet"
+    assert store.generation == generation + 1
+
+
+def test_page_and_search(tmp_path):
+    store = make_store(tmp_path, [("b two", "x"), ("A one", "y"), ("c three", "x")])
+    assert store.page(1, 2) == ([("A one", "y"), ("b two", "x")], 3)
+    assert store.page(2, 2) == ([("c three", "x")], 3)
+    assert store.page(intent="x") == ([("b two", "x"), ("c three", "x")], 2)
+    store.write([{"op": "add", "text": "two more", "intent": "y", "entities": []}])
+    assert store.page(q="two") == ([("b two", "x"), ("two more", "y")], 2)
+
+
+def test_append_failure_makes_the_next_read_reload(tmp_path, monkeypatch):
+    store = make_store(tmp_path, [("hello", "greet")])
+    store.apply([{"op": "add", "text": "hi", "intent": "greet", "entities": []}])
+    store.journal_path = str(tmp_path / "missing" / "test.json.journal")
+    with pytest.raises(OSError):
+        store.append([{"op": "add", "text": "hi", "intent": "greet", "entities": []}])
+    store.journal_path = f"{store.file_path}.journal"
+
+    # Memory was ahead of the disk, the reload drops the edit that was never written
+    assert store.get("hi") is None
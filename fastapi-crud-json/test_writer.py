@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+
+from backend import NluBackend
+from store import GroupCommitWriter
+
+
+class MemoryBackend(NluBackend):
+    """
+    Backend keeping the edits in memory, recording every append.
+    """
+
+    def __init__(self):
+        self.text_intent = {}
+        self.appended = []
+        self.fail_apply = set()
+        self.fail_append = False
+
+    def intent_names(self):
+        return set(self.text_intent.values())
+
+    def get(self, text):
+        return self.text_intent.get(text)
+
+    def page(self, page=1, page_size=50, intent=None, q=None):
+        return sorted(self.text_intent.items()), len(self.text_intent)
+
+    def iter_examples(self):
+        for text, intent in self.text_intent.items():
+            yield {"text": text, "intent": intent, "entities": []}
+
+    def apply(self, entries):
+        for entry in entries:
+            if entry['text'] in self.fail_apply:
+                raise KeyError(entry['text'])
+            if entry['op'] == 'remove':
+                self.text_intent.pop(entry['text'], None)
+            else:
+                self.text_intent[entry['text']] = entry['intent']
+
+    def append(self, entries):
+        if self.fail_append:
+            raise OSError("disk full")
+        self.appended.append(list(entries))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def started(store, **kwargs):
+    writer = GroupCommitWriter(store, **kwargs)
+    writer.start()
+    return writer
+
+
+def test_concurrent_edits_are_committed_in_batches():
+    store = MemoryBackend()
+
+    async def main():
+        writer = await started(store)
+        await asyncio.gather(*(writer.add(f"text {i}", "x") for i in range(50)))
+        await writer.stop()
+        return writer
+
+    writer = run(main())
+    assert len(store.text_intent) == 50
+    assert writer.edits == 50
+    # Every edit queued while the first was committed goes in the second batch
+    assert writer.batches == len(store.appended) < 50
+    assert sum(len(batch) for batch in store.appended) == 50
+
+
+def test_batches_are_capped_at_max_batch():
+    store = MemoryBackend()
+
+    async def main():
+        writer = await started(store, max_batch=8)
+        await asyncio.gather(*(writer.add(f"text {i}", "x") for i in range(30)))
+        await writer.stop()
+
+    run(main())
+    assert max(len(batch) for batch in store.appended) <= 8
+
+
+def test_malformed_edit_is_refused_before_it_is_queued():
+    store = MemoryBackend()
+
+    async def main():
+        writer = await started(store)
+        with pytest.raises(ValueError):
+            await writer.submit({"op": "rename", "text": "a"})
+        with pytest.raises(ValueError):
+            await writer.submit({"op": "add", "text": "a"})
+        await writer.stop()
+        return writer
+
+    assert run(main()).edits == 0
+    assert store.appended == []
+
+
+def test_edit_failing_to_apply_fails_alone():
+    store = MemoryBackend()
+    store.fail_apply.add("bad")
+
+    async def main():
+        writer = await started(store)
+        results = await asyncio.gather(writer.add("good", "x"), writer.add("bad", "x"), writer.add("fine", "y"),
+                                       return_exceptions=True)
+        await writer.stop()
+        return results
+
+    good, bad, fine = run(main())
+    assert good is None and fine is None
+    assert isinstance(bad, KeyError)
+    assert store.text_intent == {"good": "x", "fine": "y"}
+    # Only the applied edits reach the journal
+    assert [entry['text'] for batch in store.appended for entry in batch] == ["good", "fine"]
+
+
+def test_append_failure_reaches_every_waiter_of_the_batch():
+    store = MemoryBackend()
+    store.fail_append = True
+
+    async def main():
+        writer = await started(store)
+        results = await asyncio.gather(*(writer.add(f"text {i}", "x") for i in range(5)), return_exceptions=True)
+        store.fail_append = False
+        # The writer keeps going after a failed batch
+        await writer.add("after", "x")
+        await writer.stop()
+        return results
+
+    results = run(main())
+    assert all(isinstance(result, OSError) for result in results)
+    assert store.appended == [[{"op": "add", "text": "after", "intent": "x", "entities": []}]]
+
+
+def test_failing_listener_does_not_fail_the_edits():
+    store = MemoryBackend()
+    seen = []
+
+    def broken(entries):
+        raise RuntimeError("listener")
+
+    async def main():
+        writer = await started(store)
+        writer.listeners.extend([broken, seen.extend])
+        await asyncio.gather(writer.add("a", "x"), writer.remove("a"))
+        await writer.stop()
+
+    run(main())
+    assert [entry['op'] for entry in seen] == ["add", "remove"]
+    assert store.text_intent == {}
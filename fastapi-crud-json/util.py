@@ -1,6 +1,8 @@
 # train rasa with the specified data inside Input Folder
 import json
 
+from store import store
+
 
 def validate_data(text, intent, entities_list):
     final_text = text
@@ -27,50 +29,12 @@ def validate_data(text, intent, entities_list):
 
 
 def add_json(k, v):
-    file = open('static/test.json', 'r+', encoding="utf8")
-    # Move the file pointer to the beginning
-    file.seek(0)
-    json_data = json.load(file)
-
-    # Add new data to the existing JSON
-    final_data = {
-        "rasa_nlu_data": {
-            "common_examples": [
-                {
-                    "text": k,
-                    "intent": v,
-                    "entities": []
-                }
-            ]
-        }
-    }
-    json_data["rasa_nlu_data"]["common_examples"].extend(final_data["rasa_nlu_data"]["common_examples"])
-
-    # Move the file pointer to the beginning to overwrite the file
-    file.seek(0)
-
-    # Write the updated JSON data
-    json.dump(json_data, file, indent=4)
-
-    # Truncate the remaining content after the updated JSON data
-    file.truncate()
-    file.close()
+    store.write([{"op": "add", "text": k, "intent": v, "entities": []}])
 
 
 def read_json():
     try:
-        with open('static/test.json', 'r', encoding="utf-8-sig") as f:
-            json_data = json.load(f)
-
-        intends = set()
-        nlu_dict = {}
-        for i in json_data['rasa_nlu_data']['common_examples']:
-            text = i['text']
-            intent = i['intent']
-            intends.add(intent)
-            nlu_dict[text] = intent
-
-        return nlu_dict, intends
+        return store.read()
 
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print("An error occurred while processing the JSON file:", e)
@@ -80,36 +44,10 @@ def read_json():
 # read_json()
 def remove_json(k, v=""):
     try:
-        with open('./static/test.json', 'r', encoding="utf-8") as file:
-            json_data = json.load(file)
-        
-        final_data = {
-            "text": k,
-            "intent": v,
-            "entities": []
-        }
-        
-        # Remove the entry from the JSON data
-        common_examples = json_data["rasa_nlu_data"]["common_examples"]
-        common_examples = [example for example in common_examples if example["text"] != final_data["text"]]
-        json_data["rasa_nlu_data"]["common_examples"] = common_examples
-        
-        with open('./static/test.json', 'w', encoding="utf-8") as file:
-            json.dump(json_data, file, indent=4)
-            
+        store.write([{"op": "remove", "text": k}])
     except (FileNotFoundError, json.JSONDecodeError) as e:
         print("An error occurred while processing the JSON file:", e)
 
-def update_json(text, intent=""):
-    with open('./static/test.json', 'r+', encoding="utf8") as fp:
-        # Move the file pointer to the beginning
-        fp.seek(0)
-        json_data = json.load(fp)
-        common_examples = json_data["rasa_nlu_data"]["common_examples"]
-        for example in common_examples:
-            if example["text"] == text:
-                example['intent'] = intent
 
-        fp.seek(0)
-        fp.truncate()
-        json.dump(json_data, fp, indent=4)
+def update_json(text, intent=""):
+    store.write([{"op": "update", "text": text, "intent": intent}])
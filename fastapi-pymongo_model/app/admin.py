@@ -1,13 +1,169 @@
 import os
+from threading import Lock
+from threading import get_ident
+from time import perf_counter
+
 from pymongo import MongoClient
+from pymongo import UpdateOne
+from pymongo import monitoring
 from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorClient
 
-os.environ["MONGO_URI"] = "mongodb://localhost:27017/"
+os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017/")
 
+# Connection pool of the shared client
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+# Milliseconds a request waits for a free connection before failing
+MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv("MONGO_SOCKET_TIMEOUT_MS", 10000))
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Counts what the connection pool does, for sizing it under load.
+
+    Wait time is from asking for a connection to getting it, measured per
+    thread since a checkout never leaves the thread that started it.
+    """
 
-class Model:
     def __init__(self):
-        self.mongo_client = MongoClient(os.environ["MONGO_URI"])
+        self.lock = Lock()
+        self.started = {}
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.cleared = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.closed += 1
+
+    def connection_check_out_started(self, event):
+        self.started[get_ident()] = perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self.started.pop(get_ident(), None)
+        with self.lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        started = self.started.pop(get_ident(), None)
+        wait = perf_counter() - started if started is not None else 0.0
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "max_pool_size": MONGO_MAX_POOL_SIZE,
+                "min_pool_size": MONGO_MIN_POOL_SIZE,
+                "open": self.created - self.closed,
+                "created": self.created,
+                "closed": self.closed,
+                "checked_out": self.checked_out,
+                "max_checked_out": self.max_checked_out,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "avg_wait_ms": round(self.wait_time / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "max_wait_ms": round(self.max_wait_time * 1000, 3),
+                "cleared": self.cleared,
+            }
+
+
+# One listener per client, each client has its own pool
+pool_stats = PoolStats()
+async_pool_stats = PoolStats()
+
+# The one client of the app, opened on startup and closed on shutdown
+mongo_client = None
+
+
+def connect():
+    global mongo_client
+    if mongo_client is None:
+        mongo_client = MongoClient(os.environ["MONGO_URI"],
+                                   maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                   minPoolSize=MONGO_MIN_POOL_SIZE,
+                                   waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                                   serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                                   connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                                   socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                                   event_listeners=[pool_stats])
+    return mongo_client
+
+
+def disconnect():
+    global mongo_client
+    if mongo_client is not None:
+        mongo_client.close()
+        mongo_client = None
+
+
+# The Motor client of the async routes, same settings, its own pool statistics
+async_mongo_client = None
+
+
+def async_connect():
+    global async_mongo_client
+    if async_mongo_client is None:
+        async_mongo_client = AsyncIOMotorClient(os.environ["MONGO_URI"],
+                                                maxPoolSize=MONGO_MAX_POOL_SIZE,
+                                                minPoolSize=MONGO_MIN_POOL_SIZE,
+                                                waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+                                                serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                                                connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                                                socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+                                                event_listeners=[async_pool_stats])
+    return async_mongo_client
+
+
+def async_disconnect():
+    global async_mongo_client
+    if async_mongo_client is not None:
+        async_mongo_client.close()
+        async_mongo_client = None
+
+
+class Model:
+    def __init__(self, client=None):
+        # Every Model shares the client and its pool, creating one is cheap
+        self.mongo_client = client if client is not None else connect()
         self.db = self.mongo_client.crudpymongo
         self.intent = self.db['intent']
 
@@ -16,13 +172,50 @@ class Model:
             "model_name": name
         })
 
+    def create_indexes(self):
+        # Lets the database reject a second intent of the same name
+        self.intent.create_index("intent_name", unique=True)
+
     def add_intent(self, intent, description):
-        self.intent.insert_one({
-            "intent_name": intent,
-            "description": description
-        })
+        """
+        Insert an intent unless one of that name exists, in one round trip.
+
+        The upsert only writes on insert, so an existing intent is left alone
+        even when the unique index could not be created. With the index a
+        concurrent insert of the same name raises DuplicateKeyError.
+
+        :return: True when the intent was inserted.
+        """
+        result = self.intent.update_one({"intent_name": intent},
+                                        {"$setOnInsert": {"intent_name": intent, "description": description}},
+                                        upsert=True)
+        return result.upserted_id is not None
+
+    def upsert_intents(self, intents):
+        """
+        Insert missing intents with one unordered bulk_write.
+
+        :param intents: List of (intent, description). An empty description
+            leaves the description of an existing intent alone, any other
+            replaces it.
+        :return: The BulkWriteResult.
+        """
+        requests = []
+        for intent, description in intents:
+            if description:
+                update = {"$setOnInsert": {"intent_name": intent}, "$set": {"description": description}}
+            else:
+                update = {"$setOnInsert": {"intent_name": intent, "description": ""}}
+            requests.append(UpdateOne({"intent_name": intent}, update, upsert=True))
+        return self.intent.bulk_write(requests, ordered=False)
 
     def set_intent(self, id, intent, description):
+        """
+        :return: False, leaving the intent unchanged, when another intent has the new name.
+        """
+        # The unique index rejects a rename racing this check, the check covers a missing index
+        if self.intent.find_one({"intent_name": intent, "_id": {"$ne": ObjectId(id)}}, {"_id": 1}):
+            return False
         self.intent.update_one(
             {"_id": ObjectId(id)},
             {"$set":
@@ -32,13 +225,56 @@ class Model:
                 }
             }
         )
+        return True
 
     def get_intent(self):
         return list(self.intent.find())
 
     def close_conn(self):
-        self.mongo_client.close()
-        print("obj destroy")
+        # The shared client stays open, disconnect closes it on shutdown
+        pass
 
     def remove_intent(self, id):
         self.intent.delete_one({'_id': ObjectId(id)})
+
+
+class AsyncModel:
+    """
+    Model on Motor for async routes, the same methods as coroutines.
+
+    The event loop keeps serving other requests while one waits on Mongo.
+    """
+
+    def __init__(self, client=None):
+        self.mongo_client = client if client is not None else async_connect()
+        self.db = self.mongo_client.crudpymongo
+        self.intent = self.db['intent']
+
+    async def create_indexes(self):
+        await self.intent.create_index("intent_name", unique=True)
+
+    async def add_intent(self, intent, description):
+        result = await self.intent.update_one({"intent_name": intent},
+                                              {"$setOnInsert": {"intent_name": intent, "description": description}},
+                                              upsert=True)
+        return result.upserted_id is not None
+
+    async def set_intent(self, id, intent, description):
+        if await self.intent.find_one({"intent_name": intent, "_id": {"$ne": ObjectId(id)}}, {"_id": 1}):
+            return False
+        await self.intent.update_one(
+            {"_id": ObjectId(id)},
+            {"$set":
+                {
+                    "intent_name": intent,
+                    "description": description,
+                }
+            }
+        )
+        return True
+
+    async def get_intent(self):
+        return await self.intent.find().to_list(None)
+
+    async def remove_intent(self, id):
+        await self.intent.delete_one({'_id': ObjectId(id)})
@@ -0,0 +1,64 @@
+from abc import ABC, abstractmethod
+
+
+class NluBackend(ABC):
+    """
+    Storage of NLU training examples.
+
+    Edits are dicts with op (add, update or remove), text and intent.
+    util.write_examples hands them to write from the request threads, one
+    call per request; write applies them and makes them durable before it
+    returns. Export and the duplicate index read the examples back with
+    iter_examples, util turns them into Rasa JSON or YAML.
+
+    generation changes whenever the examples change outside the app, the
+    duplicate index is rebuilt then.
+    """
+
+    generation = 0
+
+    @abstractmethod
+    def intent_names(self):
+        """
+        Set of every intent that has examples.
+        """
+
+    @abstractmethod
+    def get(self, text):
+        """
+        Intent of a text, or None.
+        """
+
+    @abstractmethod
+    def page(self, page=1, page_size=50, intent=None, q=None):
+        """
+        One page of examples in text order, optionally of one intent and matching q.
+
+        :return: List of (text, intent) on the page and the number of matches.
+        """
+
+    @abstractmethod
+    def iter_examples(self):
+        """
+        Yield every example as a Rasa example dict.
+        """
+
+    def apply(self, entries):
+        pass
+
+    @abstractmethod
+    def append(self, entries):
+        """
+        Make edits durable, one call per write.
+        """
+
+    def write(self, entries):
+        self.apply(entries)
+        self.append(entries)
+
+    def read(self):
+        """
+        text -> intent of every example and the set of intents.
+        """
+        text_intent = {example['text']: example['intent'] for example in self.iter_examples()}
+        return text_intent, set(text_intent.values())
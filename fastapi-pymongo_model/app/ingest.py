@@ -0,0 +1,88 @@
+"""
+Bulk ingest of the intents of an NLU training file into Mongo.
+
+The file is read one example at a time and every new intent name is
+upserted, in unordered bulk_write batches of --batch-size intents. Existing
+intents keep their document, descriptions come from an optional JSON file
+mapping intent names to descriptions.
+
+    python ingest.py
+    python ingest.py ./input/data.json --descriptions ./input/descriptions.json --batch-size 500
+"""
+import json
+import argparse
+
+from time import perf_counter
+
+from admin import Model, disconnect
+from store import store, iter_rasa_file
+
+# Intents sent to Mongo in one bulk_write
+INGEST_BATCH_SIZE = 1000
+
+
+def iter_intent_batches(examples, batch_size=INGEST_BATCH_SIZE, descriptions=None):
+    """
+    Yield lists of (intent, description) for the distinct intents of examples.
+    """
+    descriptions = descriptions or {}
+    seen = set()
+    batch = []
+    for example in examples:
+        intent = example['intent']
+        if intent in seen:
+            continue
+        seen.add(intent)
+        batch.append((intent, descriptions.get(intent, "")))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    # Intents of the mapping that no example uses yet
+    for intent, description in descriptions.items():
+        if intent not in seen:
+            seen.add(intent)
+            batch.append((intent, description))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def ingest_intents(model, examples, batch_size=INGEST_BATCH_SIZE, descriptions=None):
+    """
+    Upsert the intents of examples into the intent collection.
+
+    :return: Counts of intents read, inserted, updated and unchanged, batches and throughput.
+    """
+    started = perf_counter()
+    stats = {"intents": 0, "inserted": 0, "updated": 0, "unchanged": 0, "batches": 0}
+    for batch in iter_intent_batches(examples, batch_size, descriptions):
+        result = model.upsert_intents(batch)
+        stats["intents"] += len(batch)
+        stats["batches"] += 1
+        stats["inserted"] += result.upserted_count
+        stats["updated"] += result.modified_count
+        stats["unchanged"] += result.matched_count - result.modified_count
+    elapsed = perf_counter() - started
+    stats["time"] = round(elapsed, 3)
+    stats["intents_per_sec"] = round(stats["intents"] / elapsed, 1) if elapsed else 0.0
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("file", nargs="?", help="Rasa JSON training file, the app's NLU store when left out")
+    parser.add_argument("--descriptions", help="JSON file mapping intent names to descriptions")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    args = parser.parse_args()
+
+    descriptions = None
+    if args.descriptions:
+        with open(args.descriptions, 'r', encoding="utf8") as f:
+            descriptions = json.load(f)
+    examples = iter_rasa_file(args.file) if args.file else store.iter_examples()
+    try:
+        print(json.dumps(ingest_intents(Model(), examples, args.batch_size, descriptions), indent=4))
+    finally:
+        disconnect()
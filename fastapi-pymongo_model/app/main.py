@@ -1,12 +1,19 @@
-from fastapi import FastAPI, Request, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+import asyncio
+
+from time import perf_counter
+
+from fastapi import FastAPI, Request, Form, HTTPException, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette import status
+from pymongo.errors import DuplicateKeyError, PyMongoError
 
 
-from util import read_json, add_json, remove_json
-from admin import Model
+from util import read_json, add_json, remove_json, iter_training_data, duplicate_index, EXPORT_FORMATS
+from admin import Model, AsyncModel, connect, disconnect, async_connect, async_disconnect, pool_stats, async_pool_stats
+from store import store
+from ingest import ingest_intents, INGEST_BATCH_SIZE
 
 app = FastAPI()
 
@@ -15,11 +22,25 @@ app.mount("/static", StaticFiles(directory="./static"), name="static")
 templates = Jinja2Templates(directory="./templates")
 
 
-def add_bulk_intent():
-    admin = Model()
-    d, intents = read_json()
-    for intent in intents:
-        admin.add_intent(intent)
+@app.on_event("startup")
+async def open_mongo():
+    connect()
+    async_connect()
+    try:
+        await AsyncModel().create_indexes()
+    except PyMongoError as e:
+        # add_intent and set_intent still refuse duplicates, only without the index to back them
+        print("Could not create the intent indexes:", e)
+
+
+@app.on_event("shutdown")
+def close_mongo():
+    async_disconnect()
+    disconnect()
+
+
+def add_bulk_intent(batch_size=INGEST_BATCH_SIZE):
+    return ingest_intents(Model(), store.iter_examples(), batch_size)
 
 
 def get_intent_list():
@@ -30,38 +51,49 @@ def get_intent_list():
 
 @app.get("/", response_class=HTMLResponse)
 async def bui_add_intent(request: Request):
-    intent = get_intent_list()
+    intent = await AsyncModel().get_intent()
     context = {"request": request, "intents": intent}
     return templates.TemplateResponse('index.html', context=context)
 
 
 @app.post("/add_intent")
 async def bui_add_intent_db(request: Request, intent: str = Form(), description: str = Form()):
-    admin = Model()
-    intents = admin.get_intent()
-    intent_list = []
-    for intent_val in intents:
-        intent_list.append(intent_val['intent_name'])
-    if  intent in intent_list:
-        context = {"request": request, "intent_error": "Intent is already exist!!", "intents": intents}
+    admin = AsyncModel()
+    try:
+        added = await admin.add_intent(intent, description)
+    except DuplicateKeyError:
+        added = False
+    if not added:
+        context = {"request": request, "intent_error": "Intent is already exist!!", "intents": await admin.get_intent()}
         return templates.TemplateResponse('index.html', context=context)
-    else:
-        admin.add_intent(intent, description)
     return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
 
 
+# Seed the intent collection from the NLU training data
+@app.post("/ingest_intents")
+def bui_ingest_intents(batch_size: int = Query(INGEST_BATCH_SIZE, ge=1, le=100000)):
+    return add_bulk_intent(batch_size)
+
+
 @app.post("/update_intent")
-async def bui_update_intent_db(id=Form(), intent: str = Form(), description: str = Form()):
-    admin = Model()
+async def bui_update_intent_db(request: Request, id=Form(), intent: str = Form(), description: str = Form()):
+    admin = AsyncModel()
     print(intent)
-    admin.set_intent(id, intent, description)
+    try:
+        renamed = await admin.set_intent(id, intent, description)
+    except DuplicateKeyError:
+        renamed = False
+    if not renamed:
+        # Renamed to the name of another intent
+        context = {"request": request, "intent_error": "Intent is already exist!!", "intents": await admin.get_intent()}
+        return templates.TemplateResponse('index.html', context=context)
     return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
 
 
 @app.post("/remove_intent")
 async def bui_remove_intent_db(id_intent=Form()):
-    admin = Model()
-    admin.remove_intent(id_intent)
+    admin = AsyncModel()
+    await admin.remove_intent(id_intent)
     return RedirectResponse("/", status_code=status.HTTP_302_FOUND)
 
 
@@ -70,21 +102,62 @@ async def bui_remove_intent_db(id_intent=Form()):
 
 @app.get('/nlu_data', response_class=HTMLResponse)
 async def backend_ui_nlu(request: Request):
-    nlu_data, intends = read_json()
-    intent = get_intent_list()
+    # The file is read in a thread while Mongo answers
+    (nlu_data, intends), intent = await asyncio.gather(asyncio.to_thread(read_json), AsyncModel().get_intent())
     return templates.TemplateResponse('index.html',
                                       {"request": request, "nlu_data": nlu_data, "intends": intent})
 
 @app.post("/add_nlu", response_class=HTMLResponse)
-def admin_model_config(sentence=Form(), intent=Form()):
+def admin_model_config(request: Request, sentence=Form(), intent=Form(), force: bool = Form(False)):
+    matches = duplicate_index().find(sentence)
+    wants_json = "application/json" in request.headers.get("accept", "")
+    if matches and not force:
+        # Nothing is saved until the sentence is sent again with force
+        if wants_json:
+            return JSONResponse({"added": False, "duplicates": matches}, status_code=status.HTTP_409_CONFLICT)
+        context = {"request": request, "intents": get_intent_list(), "duplicates": matches,
+                   "pending": {"sentence": sentence, "intent": intent}}
+        return templates.TemplateResponse('index.html', context=context)
     add_json(sentence, intent)
     print(sentence, intent)
+    if wants_json:
+        return JSONResponse({"added": True, "duplicates": matches})
     return RedirectResponse("/nlu_data", status_code=status.HTTP_302_FOUND)
 
 
+@app.get("/nlu_duplicates")
+def duplicate_report():
+    started = perf_counter()
+    index = duplicate_index()
+    groups = index.report()
+    return {
+        "groups": len(groups),
+        "conflicts": sum(group["conflict"] for group in groups),
+        "time": round(perf_counter() - started, 3),
+        "index": index.stats(),
+        "report": groups,
+    }
+
+
 @app.post("/nlu_delete", response_class=HTMLResponse)
 def admin_model_config(sentence=Form(), intent: str = Form(default="")):
     print(sentence, intent)
     remove_json(sentence, intent)
 
     return RedirectResponse("/nlu_data", status_code=status.HTTP_302_FOUND)
+
+
+# Rasa training data streamed from the store, json or yaml
+@app.get("/export")
+def export_training_data(fmt: str = "json"):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {fmt}, use one of {', '.join(EXPORT_FORMATS)}")
+    chunks, media_type, extension = EXPORT_FORMATS[fmt]
+    return StreamingResponse(chunks(iter_training_data()), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="nlu.{extension}"'})
+
+
+# Connection pools of the MongoClient and the Motor client, for sizing MONGO_MAX_POOL_SIZE
+@app.get("/mongo/pool")
+def mongo_pool():
+    return {"sync": pool_stats.to_dict(), "async": async_pool_stats.to_dict()}
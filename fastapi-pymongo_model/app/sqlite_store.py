@@ -0,0 +1,150 @@
+import re
+import json
+import sqlite3
+
+from os import path
+from threading import Lock
+
+from backend import NluBackend
+
+NLU_DB = './input/nlu.db'
+
+WORD = re.compile(r"\w+")
+
+# Kept in PRAGMA user_version, a change of SCHEMA bumps it and migrates older databases on open
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS examples (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL,
+    intent TEXT NOT NULL,
+    entities TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS examples_by_text ON examples (text);
+CREATE TABLE IF NOT EXISTS texts (
+    id INTEGER PRIMARY KEY,
+    text TEXT NOT NULL UNIQUE,
+    text_key TEXT NOT NULL,
+    intent TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS texts_order ON texts (text_key, text);
+CREATE INDEX IF NOT EXISTS texts_intent ON texts (intent, text_key, text);
+CREATE VIRTUAL TABLE IF NOT EXISTS texts_fts USING fts5 (text, content='texts', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS texts_ai AFTER INSERT ON texts BEGIN
+    INSERT INTO texts_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS texts_ad AFTER DELETE ON texts BEGIN
+    INSERT INTO texts_fts (texts_fts, rowid, text) VALUES ('delete', old.id, old.text);
+END;
+"""
+
+UPSERT_TEXT = ("INSERT INTO texts (text, text_key, intent) VALUES (?, ?, ?) "
+               "ON CONFLICT (text) DO UPDATE SET intent = excluded.intent")
+
+
+class SqliteStore(NluBackend):
+    """
+    NLU examples in SQLite, for corpora too big to rewrite as one JSON file.
+
+    examples holds every example in file order, for export. texts holds each
+    distinct text once with the intent of its last example, like the JSON
+    file store, and is what pages and search read: it is indexed by text for
+    lookups and by (text_key, text) and (intent, text_key, text) so a page is
+    read in index order without sorting, and an FTS5 table over it serves
+    search. text_key is the lower case text, computed in Python so the order
+    matches the JSON file store. Edits come from util.write_examples, one
+    transaction per request, and /export streams the examples in file order.
+
+    :param db_path: The SQLite database file.
+    :param import_path: Rasa JSON file loaded into the database when it is empty.
+    """
+
+    def __init__(self, db_path=NLU_DB, import_path=None):
+        self.db_path = db_path
+        self.write_lock = Lock()
+        self.read_lock = Lock()
+        self.writer = self._connect()
+        self.writer.executescript(SCHEMA)
+        self.writer.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        # Request threads read through their own connection, WAL lets them run beside a write
+        self.reader = self._connect()
+        if import_path and path.exists(import_path) and self._count() == 0:
+            self.import_json(import_path)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _count(self):
+        with self.read_lock:
+            return self.reader.execute("SELECT COUNT(*) FROM examples").fetchone()[0]
+
+    def import_json(self, file_path):
+        with open(file_path, 'r', encoding="utf-8-sig") as f:
+            examples = json.load(f)['rasa_nlu_data']['common_examples']
+        with self.write_lock, self.writer:
+            self.writer.executemany(
+                "INSERT INTO examples (text, intent, entities) VALUES (?, ?, ?)",
+                ((example['text'], example['intent'], json.dumps(example.get('entities', []))) for example in examples))
+            self.writer.executemany(UPSERT_TEXT, ((example['text'], example['text'].lower(), example['intent'])
+                                                  for example in examples))
+
+    def intent_names(self):
+        with self.read_lock:
+            return {row[0] for row in self.reader.execute("SELECT DISTINCT intent FROM texts")}
+
+    def get(self, text):
+        with self.read_lock:
+            row = self.reader.execute("SELECT intent FROM texts WHERE text = ?", (text,)).fetchone()
+        return row[0] if row else None
+
+    def page(self, page=1, page_size=50, intent=None, q=None):
+        conditions, parameters = [], []
+        source = "texts t"
+        q = (q or "").strip().lower()
+        if q:
+            words = WORD.findall(q)
+            if not words:
+                return [], 0
+            source = "texts_fts f JOIN texts t ON t.id = f.rowid"
+            conditions.append("texts_fts MATCH ?")
+            parameters.append(" ".join(f'"{word}"*' for word in words))
+            conditions.append("instr(t.text_key, ?) > 0")
+            parameters.append(q)
+        if intent:
+            conditions.append("t.intent = ?")
+            parameters.append(intent)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self.read_lock:
+            total = self.reader.execute(f"SELECT COUNT(*) FROM {source} {where}", parameters).fetchone()[0]
+            # Without q the rows come straight from texts_order or texts_intent, no sort
+            rows = self.reader.execute(
+                f"SELECT t.text, t.intent FROM {source} {where} ORDER BY t.text_key, t.text LIMIT ? OFFSET ?",
+                parameters + [page_size, (page - 1) * page_size]).fetchall()
+        return rows, total
+
+    def iter_examples(self):
+        # A connection of its own, so a long export never holds up the readers
+        connection = sqlite3.connect(self.db_path)
+        try:
+            for text, intent, entities in connection.execute("SELECT text, intent, entities FROM examples ORDER BY id"):
+                yield {"text": text, "intent": intent, "entities": json.loads(entities)}
+        finally:
+            connection.close()
+
+    def append(self, entries):
+        with self.write_lock, self.writer:
+            for entry in entries:
+                if entry['op'] == 'add':
+                    self.writer.execute("INSERT INTO examples (text, intent, entities) VALUES (?, ?, ?)",
+                                        (entry['text'], entry['intent'], json.dumps(entry.get('entities', []))))
+                    self.writer.execute(UPSERT_TEXT, (entry['text'], entry['text'].lower(), entry['intent']))
+                elif entry['op'] == 'update':
+                    self.writer.execute("UPDATE examples SET intent = ? WHERE text = ?", (entry['intent'], entry['text']))
+                    self.writer.execute("UPDATE texts SET intent = ? WHERE text = ?", (entry['intent'], entry['text']))
+                elif entry['op'] == 'remove':
+                    self.writer.execute("DELETE FROM examples WHERE text = ?", (entry['text'],))
+                    self.writer.execute("DELETE FROM texts WHERE text = ?", (entry['text'],))
@@ -0,0 +1,137 @@
+import re
+import json
+
+from os import getenv
+from os import stat
+
+from backend import NluBackend
+
+NLU_FILE = './input/data.json'
+
+# Storage of the examples: json (the training file) or sqlite
+NLU_BACKEND = getenv("NLU_BACKEND", "json")
+
+# Characters read from the training file at a time when streaming it
+READ_CHUNK = 64 * 1024
+
+EXAMPLES_START = re.compile(r'"common_examples"\s*:\s*\[')
+
+
+def iter_rasa_file(file_path, chunk_size=READ_CHUNK):
+    """
+    Yield the common_examples of a Rasa JSON file one at a time.
+
+    The file is read chunk by chunk and each example decoded with raw_decode
+    as soon as it is complete, so memory holds one chunk and one example
+    whatever the size of the file.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, 'r', encoding="utf-8-sig") as f:
+        buffer = ""
+        start = None
+        while start is None:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+            match = EXAMPLES_START.search(buffer)
+            if match:
+                start = match.end()
+            else:
+                # Keep enough to find the key split across two chunks
+                buffer = buffer[-32:]
+        buffer = buffer[start:]
+        position = 0
+        eof = False
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position == len(buffer):
+                    raise ValueError
+                example, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    raise ValueError(f"{file_path} ends inside common_examples")
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield example
+
+
+class JsonFileStore(NluBackend):
+    """
+    NLU examples kept in the Rasa training file itself.
+
+    Every read parses the file and every batch of edits rewrites it, fine for
+    a small file edited by hand. Bigger corpora belong in the sqlite backend.
+    """
+
+    def __init__(self, file_path=NLU_FILE):
+        self.file_path = file_path
+
+    @property
+    def generation(self):
+        info = stat(self.file_path)
+        return info.st_mtime_ns, info.st_size
+
+    def iter_examples(self):
+        for example in iter_rasa_file(self.file_path):
+            yield {"text": example['text'], "intent": example['intent'], "entities": example.get('entities', [])}
+
+    def intent_names(self):
+        return {example['intent'] for example in self.iter_examples()}
+
+    def get(self, text):
+        intent = None
+        for example in self.iter_examples():
+            if example['text'] == text:
+                intent = example['intent']
+        return intent
+
+    def page(self, page=1, page_size=50, intent=None, q=None):
+        text_intent, _ = self.read()
+        q = (q or "").strip().lower()
+        texts = sorted((text for text, text_intent_value in text_intent.items()
+                        if (not intent or text_intent_value == intent) and q in text.lower()),
+                       key=lambda text: (text.lower(), text))
+        offset = (page - 1) * page_size
+        return [(text, text_intent[text]) for text in texts[offset:offset + page_size]], len(texts)
+
+    def append(self, entries):
+        file = open(self.file_path, 'r+', encoding="utf8")
+        json_data = json.load(file)
+        common_examples = json_data["rasa_nlu_data"]["common_examples"]
+        for entry in entries:
+            if entry['op'] == 'add':
+                common_examples.append({"text": entry['text'], "intent": entry['intent'],
+                                        "entities": entry.get('entities', [])})
+            elif entry['op'] == 'update':
+                for example in common_examples:
+                    if example['text'] == entry['text']:
+                        example['intent'] = entry['intent']
+            elif entry['op'] == 'remove':
+                common_examples = [example for example in common_examples if example['text'] != entry['text']]
+        json_data["rasa_nlu_data"]["common_examples"] = common_examples
+
+        # Move the file pointer to the beginning to overwrite the file
+        file.seek(0)
+        json.dump(json_data, file, indent=4)
+        # Truncate the remaining content after the updated JSON data
+        file.truncate()
+        file.close()
+
+
+def make_store(backend=NLU_BACKEND):
+    if backend == "sqlite":
+        # Imported here, the JSON backend needs nothing of it
+        from sqlite_store import SqliteStore
+        return SqliteStore(import_path=NLU_FILE)
+    return JsonFileStore()
+
+
+store = make_store()
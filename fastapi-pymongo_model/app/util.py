@@ -1,6 +1,12 @@
 # train rasa with the specified data inside Input Folder
+import os
 import json
 
+from threading import RLock
+
+from store import store
+from dedup import DuplicateIndex
+
 
 def validate_data(text, intent, entities_list):
     final_text = text
@@ -26,100 +32,158 @@ def validate_data(text, intent, entities_list):
     return obj_dict
 
 
+# Index of the example texts, rebuilt when the training file changes outside the app
+duplicates = DuplicateIndex()
+# One rebuild at a time, and no write while the index is swapped
+duplicates_lock = RLock()
+
+
+def duplicate_index():
+    global duplicates
+    with duplicates_lock:
+        if duplicates.generation != store.generation:
+            duplicates = DuplicateIndex.from_store(store)
+        return duplicates
+
+
+def write_examples(entries):
+    with duplicates_lock:
+        in_sync = duplicates.generation == store.generation
+        store.write(entries)
+        duplicates.apply(entries)
+        if in_sync:
+            # Our own write, the index already follows it
+            duplicates.generation = store.generation
+
+
 def add_json(k, v):
-    file = open('./input/data.json', 'r+', encoding="utf8")
-    # Move the file pointer to the beginning
-    file.seek(0)
-    json_data = json.load(file)
-
-    # Add new data to the existing JSON
-    final_data = {
-        "rasa_nlu_data": {
-            "common_examples": [
-                {
-                    "text": k,
-                    "intent": v,
-                    "entities": []
-                }
-            ]
-        }
-    }
-    json_data["rasa_nlu_data"]["common_examples"].extend(final_data["rasa_nlu_data"]["common_examples"])
-
-    # Move the file pointer to the beginning to overwrite the file
-    file.seek(0)
-
-    # Write the updated JSON data
-    json.dump(json_data, file, indent=4)
-
-    # Truncate the remaining content after the updated JSON data
-    file.truncate()
-    file.close()
+    write_examples([{"op": "add", "text": k, "intent": v, "entities": []}])
 
 
 def read_json():
-    with open('./input/data.json', 'r', encoding="utf8") as f:
-        json_data = json.load(f)
-
-    final_data = {"rasa_nlu_data": {
-        "common_examples": [
-        ]
-    }}
-    # entities_set = set()
     intends = set()
-    question = set()
-    # synonyms = set()
     nlu_dict = {}
-    for i in json_data['rasa_nlu_data']['common_examples']:
-        text = i['text']
-        question.add(text)
-        intent = i['intent']
-        intends.add(intent)
-        entities_list = i['entities']
-        nlu_dict[text] = intent
-        # for entity in entities_list:
-        #     entities_set.add(tuple({entity[entity]: entity['value']}))
-        # entities_set.add(tuple({entities_list[0]['entity']: entities_list[0]['value']}))
-        temp_dict = validate_data(text, intent, entities_list)
-        final_data['rasa_nlu_data']['common_examples'].append(temp_dict)
-        # print(entities_list[0]['value'])
-    # print(intends, '--> intent')
-    # print(entities_set, " --> entity")
-    # file = open('../input/final_data.json', 'w', encoding="utf8")
-    # file.write(json.dumps(final_data))
-    # file.close()
+    for i in store.iter_examples():
+        nlu_dict[i['text']] = i['intent']
+        intends.add(i['intent'])
     return nlu_dict, intends
 
 
+def iter_training_data():
+    """
+    Yield every example of the store, validated, one at a time.
+    """
+    for i in store.iter_examples():
+        yield validate_data(i['text'], i['intent'], i['entities'])
+
+
+def rasa_json_chunks(examples):
+    """
+    Rasa JSON training data as text chunks, one per example.
+    """
+    yield '{\n    "rasa_nlu_data": {\n        "common_examples": ['
+    separator = "\n"
+    for example in examples:
+        yield separator + "            " + json.dumps(example, ensure_ascii=False)
+        separator = ",\n"
+    yield "\n        ]\n    }\n}\n"
+
+
+# Text of an example with its entities annotated the Rasa YAML way, [value](entity)
+def annotate_entities(example):
+    text = example['text']
+    result = []
+    position = 0
+    for entity in sorted(example['entities'], key=lambda entity: entity['start']):
+        span = text[entity['start']:entity['end']]
+        result.append(text[position:entity['start']])
+        if span == entity['value']:
+            result.append(f"[{span}]({entity['entity']})")
+        else:
+            result.append(f"[{span}]" + json.dumps({"entity": entity['entity'], "value": entity['value']}))
+        position = entity['end']
+    result.append(text[position:])
+    # A line break of any kind would end the example inside the YAML block
+    return " ".join("".join(result).splitlines())
+
+
+def rasa_yaml_chunks(examples):
+    """
+    Rasa YAML training data as text chunks.
+
+    Examples are written in the order they come, consecutive examples of an
+    intent share one block. An intent appearing again later gets another
+    block, which Rasa merges, so nothing has to be grouped in memory.
+    Intent names are written quoted, and examples without an intent are
+    left out since Rasa rejects them.
+    """
+    yield 'version: "3.1"\nnlu:\n'
+    current = None
+    for example in examples:
+        if not example['intent']:
+            continue
+        if example['intent'] != current:
+            current = example['intent']
+            # A JSON string is a YAML double quoted string, names with : or # stay one scalar
+            yield f"- intent: {json.dumps(current, ensure_ascii=False)}\n  examples: |\n"
+        yield f"    - {annotate_entities(example)}\n"
+
+
+def check_rasa_yaml(file_path, examples):
+    """
+    Load exported Rasa YAML back and compare it to what was exported.
+
+    :param examples: Number of examples per intent that were exported.
+    :raise ValueError: When the file does not hold exactly those examples.
+    """
+    # Imported here, only a YAML export needs it
+    import yaml
+    with open(file_path, 'r', encoding="utf8") as f:
+        data = yaml.safe_load(f)
+    loaded = {}
+    for block in data.get('nlu') or []:
+        intent = block.get('intent')
+        if not isinstance(intent, str) or not intent:
+            raise ValueError(f"Exported an intent block without a name: {intent!r}")
+        lines = (block.get('examples') or "").splitlines()
+        loaded[intent] = loaded.get(intent, 0) + sum(1 for line in lines if line.startswith("- "))
+    if loaded != examples:
+        raise ValueError("Exported YAML does not load back to the exported examples")
+
+
+EXPORT_FORMATS = {
+    "json": (rasa_json_chunks, "application/json", "json"),
+    "yaml": (rasa_yaml_chunks, "application/x-yaml", "yml"),
+}
+
+
+def export_rasa(file_path, fmt="json"):
+    """
+    Write the training data to a file in Rasa JSON or YAML, one example at a time.
+    """
+    chunks = EXPORT_FORMATS[fmt][0]
+    temp_path = f"{file_path}.tmp"
+    counts = {}
+
+    def counted(examples):
+        for example in examples:
+            if example['intent']:
+                counts[example['intent']] = counts.get(example['intent'], 0) + 1
+            yield example
+
+    with open(temp_path, 'w', encoding="utf8") as f:
+        for chunk in chunks(counted(iter_training_data())):
+            f.write(chunk)
+    if fmt == "yaml":
+        check_rasa_yaml(temp_path, counts)
+    os.replace(temp_path, file_path)
+    return file_path
+
+
 # read_json()
 
 def remove_json(k, v=""):
-    file = open('./input/data.json', 'r+', encoding="utf8")
-    # Move the file pointer to the beginning
-    file.seek(0)
-    json_data = json.load(file)
-    final_data = {
-
-        "text": k,
-        "intent": v,
-        "entities": []
-
-    }
-    # print(final_data)
-    # common_examples = json_data["rasa_nlu_data"]["common_examples"]
-    # for example in common_examples:
-    #     # print(example["text"])
-    #     if example["text"] == final_data["text"]:
-    #         print("yes")
-    # Remove the entry from the JSON data
-    common_examples = json_data["rasa_nlu_data"]["common_examples"]
-    common_examples = [example for example in common_examples if example["text"] != final_data["text"]]
-    json_data["rasa_nlu_data"]["common_examples"] = common_examples
-    file.seek(0)
-    json.dump(json_data, file, indent=4)
-    file.truncate()
-
-    file.close()
+    write_examples([{"op": "remove", "text": k}])
 
 
 def print_pipeline(pipeline):
@@ -133,3 +197,9 @@ def print_pipeline(pipeline):
         else:
             result.append("\t" + str(value) + '\n')
     return "\n".join(result)
+
+
+# python util.py <file> [json|yaml]
+if __name__ == "__main__":
+    import sys
+    print(export_rasa(*sys.argv[1:3]))
@@ -1,9 +1,9 @@
 import io
-import shutil
 from os import path, makedirs
 from pandas import read_csv, read_excel
 from fastapi import FastAPI, UploadFile, HTTPException
 from fastapi.responses import JSONResponse
+from uploads import save_upload, UploadTooLarge
 
 app = FastAPI()
 
@@ -46,19 +46,18 @@ async def upload_file(file: UploadFile):
     try:
         # Handle PDF
         if content_type == "application/pdf":
-            with open(file_path, "wb") as f:
-                f.write(await file.read())
+            size, sha256 = await save_upload(file, file_path)
             return {
                 "file_name": file_name,
                 "content_type": content_type,
                 "file_path": file_path,
-                "file_size_mb": f"{file.size / 1_048_576:.2f} MB",
+                "file_size_mb": f"{size / 1_048_576:.2f} MB",
+                "sha256": sha256,
             }
 
         # Handle CSV or Excel
         elif content_type in ["text/csv", "application/vnd.ms-excel", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"]:
-            with open(file_path, "wb") as f:
-                f.write(await file.read())
+            await save_upload(file, file_path)
             
             # Read CSV file
             if content_type == "text/csv":
@@ -74,12 +73,13 @@ async def upload_file(file: UploadFile):
 
         # Handle Images
         else:
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            await save_upload(file, file_path)
             return {
                 "file_name": file_name,
                 "content_type": content_type,
                 "file_path": file_path,
             }
+    except UploadTooLarge as e:
+        return JSONResponse({"error": str(e)}, status_code=413)
     except Exception as e:
         return JSONResponse({"error": f"An error occurred: {str(e)}"}, status_code=500)
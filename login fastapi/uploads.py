@@ -0,0 +1,55 @@
+from os import getenv
+from os import remove
+from hashlib import sha256
+
+from starlette.concurrency import run_in_threadpool
+
+# Bytes copied from the upload to disk per step
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Uploads larger than this are aborted and removed
+MAX_UPLOAD_BYTES = int(getenv("MAX_UPLOAD_BYTES", 512 * 1024 * 1024))
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, max_bytes):
+        super().__init__(f"File is larger than {max_bytes / 1_048_576:.0f} MB")
+        self.max_bytes = max_bytes
+
+
+async def save_upload(upload, file_path, max_bytes=MAX_UPLOAD_BYTES, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copy an UploadFile to disk in fixed size chunks.
+
+    Writing and hashing run in the threadpool, so only one chunk is held in
+    memory and the event loop never waits on the disk. A partial file is
+    removed when the upload is too large or the copy fails.
+
+    :param upload: The UploadFile to save.
+    :param file_path: Destination path.
+    :param max_bytes: Raise UploadTooLarge past this many bytes.
+    :return: Size in bytes and SHA-256 hex digest of the file.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise UploadTooLarge(max_bytes)
+
+    digest = sha256()
+    size = 0
+
+    def write(buffer, chunk):
+        digest.update(chunk)
+        buffer.write(chunk)
+
+    buffer = await run_in_threadpool(open, file_path, "wb")
+    try:
+        while chunk := await upload.read(chunk_size):
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(max_bytes)
+            await run_in_threadpool(write, buffer, chunk)
+    except BaseException:
+        buffer.close()
+        remove(file_path)
+        raise
+    buffer.close()
+    return size, digest.hexdigest()
@@ -0,0 +1,70 @@
+import zipfile
+
+from os import path
+from os import walk
+
+# Formats that are already compressed, deflating them again only costs CPU
+STORED_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp"}
+
+# Bytes read from an image per step
+ZIP_CHUNK_SIZE = 1024 * 1024
+
+
+class ZipStream:
+    """
+    Write only file object that hands out what ZipFile wrote so far.
+
+    It has no seek, so ZipFile writes sizes in data descriptors after
+    every entry instead of going back to the local headers.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def iter_zip(directory, chunk_size=ZIP_CHUNK_SIZE):
+    """
+    Yield a ZIP archive of a directory piece by piece.
+
+    At most one chunk of one file is held in memory, images that are already
+    compressed are stored as they are.
+
+    :param directory: Directory to archive, entries are named relative to it.
+    :param chunk_size: Bytes read from a file per step.
+    """
+    stream = ZipStream()
+    with zipfile.ZipFile(stream, "w") as archive:
+        for root, _, files in walk(directory):
+            for name in sorted(files):
+                file_path = path.join(root, name)
+                info = zipfile.ZipInfo.from_file(file_path, path.relpath(file_path, directory))
+                if path.splitext(name)[1].lower() in STORED_EXTENSIONS:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with open(file_path, "rb") as source, \
+                        archive.open(info, "w", force_zip64=info.file_size > zipfile.ZIP64_LIMIT) as target:
+                    for chunk in iter(lambda: source.read(chunk_size), b""):
+                        target.write(chunk)
+                        data = stream.pop()
+                        if data:
+                            yield data
+                yield stream.pop()
+    yield stream.pop()
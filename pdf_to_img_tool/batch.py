@@ -0,0 +1,165 @@
+"""
+Incremental batch converter for a folder of PDFs.
+
+Only PDFs that are new or changed since the last run are converted, all of
+their pages are rendered in parallel. The images of PDFs deleted from the
+folder are removed. A manifest next to the output keeps
+path, size, mtime, hash and the pages written for every PDF.
+
+    python batch.py ./data_pdf
+    python batch.py ./data_pdf --watch 600
+"""
+import json
+import shutil
+import argparse
+
+from os import path
+from os import stat
+from os import replace
+from os import makedirs
+from time import sleep
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+
+from cache import file_sha256
+from util import NUM_CPUS
+from util import CHUNK_SIZE
+from util import DEFAULT_OPTIONS
+from util import output_dir
+from util import find_pdfs
+from util import page_ranges
+from util import pdf_page_count
+from util import render_page_range
+
+MANIFEST_NAME = "manifest.json"
+
+
+def load_manifest(manifest_path):
+    if not path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest_path, manifest):
+    # Written next to the old one and swapped in, a crash never leaves half a manifest
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=4)
+    replace(temp_path, manifest_path)
+
+
+def changed_pdfs(pdfs, manifest):
+    """
+    PDFs that are new or changed since the manifest was written.
+
+    Size and mtime are checked first, the hash is only computed when they
+    differ, so a touched but unchanged file is not converted again.
+
+    :return: List of (pdf path, size, mtime, sha256) to convert.
+    """
+    changed = []
+    for pdf in pdfs:
+        info = stat(pdf)
+        entry = manifest.get(pdf)
+        if entry and entry["size"] == info.st_size and entry["mtime"] == info.st_mtime:
+            continue
+        pdf_hash = file_sha256(pdf)
+        if entry and entry["sha256"] == pdf_hash:
+            entry["mtime"] = info.st_mtime
+            continue
+        changed.append((pdf, info.st_size, info.st_mtime, pdf_hash))
+    return changed
+
+
+def remove_deleted(manifest, pdfs):
+    """
+    Drop the manifest entries and images of PDFs no longer in the folder.
+
+    :return: Number of PDFs removed.
+    """
+    found = set(pdfs)
+    deleted = [pdf for pdf in manifest if pdf not in found]
+    for pdf in deleted:
+        shutil.rmtree(manifest.pop(pdf)["output"], ignore_errors=True)
+    return len(deleted)
+
+
+def convert_changed(directory, output_path=output_dir, max_workers=NUM_CPUS, chunk_size=CHUNK_SIZE,
+                    options=DEFAULT_OPTIONS, dpi=300):
+    """
+    Convert the new and changed PDFs of a directory and update the manifest.
+
+    Page ranges of all PDFs share one process pool, so many small PDFs keep
+    every core as busy as one large PDF does.
+
+    :param directory: Folder scanned for PDFs.
+    :param output_path: Images of every PDF go to output_path/<path relative to directory>.
+    :return: Dict with the number of PDFs converted, failed, skipped and removed, pages and seconds.
+    """
+    makedirs(output_path, exist_ok=True)
+    manifest_path = path.join(output_path, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path)
+    time_start = perf_counter()
+    pdfs = find_pdfs(directory)
+    removed = remove_deleted(manifest, pdfs)
+    changed = changed_pdfs(pdfs, manifest)
+
+    tasks = {}
+    failed = set()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for pdf, size, mtime, pdf_hash in changed:
+            file_path = path.join(output_path, path.splitext(path.relpath(pdf, directory))[0])
+            try:
+                pages = pdf_page_count(pdf)
+            except Exception as e:
+                print(f"Failed to read page count {pdf}: {e}")
+                failed.add(pdf)
+                continue
+            # Pages of the old version must not survive next to the new ones
+            shutil.rmtree(file_path, ignore_errors=True)
+            makedirs(file_path)
+            manifest[pdf] = {"size": size, "mtime": mtime, "sha256": pdf_hash, "pages": pages, "output": file_path}
+            for first, last in page_ranges(pages, chunk_size):
+                future = executor.submit(render_page_range, pdf, file_path, first, last, 1, dpi, options)
+                tasks[future] = pdf
+
+        rendered = 0
+        for future in as_completed(tasks):
+            pdf = tasks[future]
+            try:
+                rendered += future.result()[0]
+            except Exception as e:
+                print(f"Failed to convert {pdf}: {e}")
+                failed.add(pdf)
+
+    for pdf in failed:
+        # Not recorded, so it is tried again on the next run
+        manifest.pop(pdf, None)
+    save_manifest(manifest_path, manifest)
+    return {
+        "converted": len(changed) - len(failed),
+        "failed": len(failed),
+        "skipped": len(pdfs) - len(changed),
+        "removed": removed,
+        "pages": rendered,
+        "time": round(perf_counter() - time_start, 3),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("directory", help="folder scanned for PDFs")
+    parser.add_argument("--output", default=output_dir, help="folder the images and manifest are written to")
+    parser.add_argument("--workers", type=int, default=NUM_CPUS)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--watch", type=int, default=0, metavar="SECONDS",
+                        help="rescan the folder every SECONDS seconds instead of exiting")
+    args = parser.parse_args()
+
+    while True:
+        print(convert_changed(args.directory, args.output, args.workers, args.chunk_size))
+        if not args.watch:
+            break
+        sleep(args.watch)
@@ -0,0 +1,297 @@
+"""
+Benchmarks for the pdf to image conversion.
+
+Encode benchmark: renders a few pages of a PDF once, then encodes them with
+every output option and reports encode time and bytes per page.
+
+    python benchmark.py encode ./data_pdf/sample.pdf --pages 5 --dpi 300
+
+Throughput benchmark: generates a synthetic PDF and converts it with every
+mode across a grid of dpi and worker counts, reporting pages/sec, peak RSS
+and output bytes as JSON that can be compared across commits.
+
+    python benchmark.py throughput --pages 40 --dpi 150 300 --workers 1 2 4 --output bench.json
+    python benchmark.py compare old.json bench.json
+"""
+import json
+import shutil
+import argparse
+import platform
+import subprocess
+
+from io import BytesIO
+from os import path
+from os import getpid
+from time import perf_counter
+from threading import Thread, Event
+from tempfile import mkdtemp
+
+from pdf2image import convert_from_path
+
+from cpu import processes_rss
+from cache import directory_size
+from util import NUM_CPUS
+from util import POPPLER_PATH
+from util import ImageOptions
+from util import IMAGE_FORMATS
+from util import process_pdf
+from util import pdf_to_images_chunked
+from util import pdf_to_images_multiprocessing
+
+# Output options compared by the encode benchmark
+ENCODE_OPTIONS = [
+    ImageOptions(fmt="png", compress_level=1),
+    ImageOptions(fmt="png", compress_level=6),
+    ImageOptions(fmt="png", compress_level=9),
+    ImageOptions(fmt="png", color_mode="L"),
+    ImageOptions(fmt="png", color_mode="1"),
+    ImageOptions(fmt="jpeg", quality=85),
+    ImageOptions(fmt="jpeg", quality=85, color_mode="L"),
+    ImageOptions(fmt="webp", quality=80, compress_level=4),
+    ImageOptions(fmt="webp", quality=80, compress_level=0),
+]
+
+
+def encode_benchmark(pdf_file, pages=5, dpi=300, options_list=ENCODE_OPTIONS):
+    """
+    Encode the first pages of a PDF with every option in memory.
+
+    :param pdf_file: The PDF file path.
+    :param pages: Number of pages rendered for the benchmark.
+    :param dpi: The DPI the pages are rendered at.
+    :return: One dict per option with ms and bytes per page.
+    """
+    images = convert_from_path(pdf_file, dpi=dpi, poppler_path=POPPLER_PATH, first_page=1, last_page=pages)
+    results = []
+    for options in options_list:
+        total_bytes = 0
+        time_start = perf_counter()
+        for image in images:
+            if image.mode != options.color_mode:
+                image = image.convert(options.color_mode)
+            buffer = BytesIO()
+            image.save(buffer, IMAGE_FORMATS[options.fmt][0], **options.save_params())
+            total_bytes += buffer.tell()
+        elapsed = perf_counter() - time_start
+        results.append({
+            "options": options.tag(),
+            "ms_per_page": round(elapsed * 1000 / len(images), 2),
+            "bytes_per_page": total_bytes // len(images),
+        })
+    return results
+
+
+def make_pdf(file_path, pages=20):
+    """
+    Write a synthetic PDF of text lines and grey boxes, no extra dependencies.
+
+    :param file_path: Where the PDF is written.
+    :param pages: Number of pages.
+    """
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>",
+               3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    for page in range(pages):
+        page_number, content_number = 4 + 2 * page, 5 + 2 * page
+        operations = []
+        for box in range(6):
+            grey = 0.3 + 0.1 * ((page + box) % 6)
+            operations.append(f"{grey:.1f} g {60 + 80 * box} {80 + 20 * (page % 5)} 70 120 re f")
+        operations.append("0 g")
+        for line in range(45):
+            text = f"Synthetic page {page + 1} line {line + 1} the quick brown fox jumps over the lazy dog {page * line}"
+            operations.append(f"BT /F1 10 Tf 50 {760 - 13 * line} Td ({text}) Tj ET")
+        stream = "\n".join(operations).encode()
+        objects[content_number] = b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        objects[page_number] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                                b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_number)
+        kids.append(b"%d 0 R" % page_number)
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), pages)
+
+    data = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number in range(1, len(objects) + 1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, objects[number])
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(file_path, "wb") as f:
+        f.write(data)
+    return file_path
+
+
+class PeakRss:
+    """
+    Tracks the peak resident memory of this process and all its children.
+    """
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while True:
+            self.peak = max(self.peak, processes_rss([getpid()]))
+            if self.stop_event.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.thread.join()
+
+
+# Forces the PIL decode and encode path, to compare with poppler writing the files itself
+PIL_OPTIONS = ImageOptions(direct=False)
+
+# Conversion modes compared by the throughput benchmark, each renders pdf_file into output_path
+THROUGHPUT_MODES = {
+    "process_pdf": lambda pdf_file, output_path, dpi, workers: process_pdf(
+        pdf_file, dpi=dpi, max_workers=workers, output_path=output_path),
+    "threads": lambda pdf_file, output_path, dpi, workers: pdf_to_images_multiprocessing(
+        pdf_file, dpi=dpi, max_workers=workers, output_path=output_path),
+    "threads-pil": lambda pdf_file, output_path, dpi, workers: pdf_to_images_multiprocessing(
+        pdf_file, dpi=dpi, options=PIL_OPTIONS, max_workers=workers, output_path=output_path),
+    "chunked": lambda pdf_file, output_path, dpi, workers: pdf_to_images_chunked(
+        pdf_file, dpi=dpi, max_workers=workers, output_path=output_path),
+    "chunked-pil": lambda pdf_file, output_path, dpi, workers: pdf_to_images_chunked(
+        pdf_file, dpi=dpi, options=PIL_OPTIONS, max_workers=workers, output_path=output_path),
+}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def throughput_benchmark(pages=40, dpis=(150, 300), workers=(1, 2, 4), modes=tuple(THROUGHPUT_MODES), repeat=1):
+    """
+    Convert a synthetic PDF with every mode, dpi and worker count.
+
+    :param pages: Pages of the synthetic PDF.
+    :param repeat: Runs per setting, the fastest one is kept.
+    :return: Dict with the commit, machine and one result per setting.
+    """
+    work_dir = mkdtemp(prefix="pdf-bench-")
+    pdf_file = make_pdf(path.join(work_dir, "synthetic.pdf"), pages)
+    results = []
+    try:
+        for mode in modes:
+            for dpi in dpis:
+                for worker_count in workers:
+                    best = None
+                    for run in range(repeat):
+                        output_path = path.join(work_dir, f"{mode}-{dpi}-{worker_count}-{run}")
+                        with PeakRss() as rss:
+                            time_start = perf_counter()
+                            converted = THROUGHPUT_MODES[mode](pdf_file, output_path, dpi, worker_count)
+                            elapsed = perf_counter() - time_start
+                        # process_pdf returns 0 instead of raising, a short count is a failed run, not a fast one
+                        result = {
+                            "mode": mode,
+                            "dpi": dpi,
+                            "workers": worker_count,
+                            "pages": pages,
+                            "pages_converted": converted,
+                            "ok": converted == pages,
+                            "seconds": round(elapsed, 4),
+                            "pages_per_sec": round(converted / elapsed, 3),
+                            "peak_rss": rss.peak,
+                            "output_bytes": directory_size(output_path),
+                        }
+                        shutil.rmtree(output_path, ignore_errors=True)
+                        if not result["ok"]:
+                            # A failed run is kept so the setting shows up as failed
+                            best = result
+                            break
+                        if best is None or result["seconds"] < best["seconds"]:
+                            best = result
+                    status = "" if best["ok"] else f"  FAILED {best['pages_converted']}/{pages} pages"
+                    print(f"{mode:<12} dpi={dpi:<4} workers={worker_count:<3} "
+                          f"{best['pages_per_sec']:>8} pages/sec {best['peak_rss'] / 1_048_576:>8.1f} MB{status}")
+                    results.append(best)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": NUM_CPUS,
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """
+    Print the pages/sec and peak RSS change of every setting found in both runs.
+    """
+    def settings(report):
+        return {(r["mode"], r["dpi"], r["workers"]): r for r in report["results"]}
+
+    old_results, new_results = settings(old), settings(new)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    for key in sorted(old_results.keys() & new_results.keys()):
+        before, after = old_results[key], new_results[key]
+        if not before.get("ok", True) or not after.get("ok", True):
+            print(f"{key[0]:<12} dpi={key[1]:<4} workers={key[2]:<3} failed run, not compared")
+            continue
+        speed = after["pages_per_sec"] / before["pages_per_sec"]
+        memory = after["peak_rss"] / before["peak_rss"] if before["peak_rss"] else 0.0
+        print(f"{key[0]:<12} dpi={key[1]:<4} workers={key[2]:<3} speed x{speed:.2f}  peak rss x{memory:.2f}")
+
+
+def print_table(results):
+    print(f"{'options':<24}{'ms/page':>12}{'KB/page':>12}")
+    for result in results:
+        print(f"{result['options']:<24}{result['ms_per_page']:>12}{result['bytes_per_page'] / 1024:>12.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    encode = commands.add_parser("encode", help="encode time and size per output option")
+    encode.add_argument("pdf_file")
+    encode.add_argument("--pages", type=int, default=5)
+    encode.add_argument("--dpi", type=int, default=300)
+    encode.add_argument("--json", dest="json_file", help="also write the results to this file")
+
+    throughput = commands.add_parser("throughput", help="pages/sec, peak RSS and output bytes per setting")
+    throughput.add_argument("--pages", type=int, default=40)
+    throughput.add_argument("--dpi", type=int, nargs="+", default=[150, 300])
+    throughput.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    throughput.add_argument("--modes", nargs="+", choices=list(THROUGHPUT_MODES), default=list(THROUGHPUT_MODES))
+    throughput.add_argument("--repeat", type=int, default=1)
+    throughput.add_argument("--output", default="bench.json")
+
+    comparison = commands.add_parser("compare", help="compare two throughput JSON files")
+    comparison.add_argument("old")
+    comparison.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "encode":
+        results = encode_benchmark(args.pdf_file, args.pages, args.dpi)
+        print_table(results)
+        if args.json_file:
+            with open(args.json_file, "w") as f:
+                json.dump(results, f, indent=4)
+    elif args.command == "throughput":
+        report = throughput_benchmark(args.pages, args.dpi, args.workers, args.modes, args.repeat)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=4)
+        print(f"Results written to {args.output}")
+        if not all(result["ok"] for result in report["results"]):
+            raise SystemExit("Some settings did not convert every page")
+    else:
+        with open(args.old) as f_old, open(args.new) as f_new:
+            compare(json.load(f_old), json.load(f_new))
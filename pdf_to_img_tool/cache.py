@@ -0,0 +1,233 @@
+import shutil
+
+from os import path
+from os import getenv
+from os import link
+from os import listdir
+from os import makedirs
+from os import remove
+from os import replace
+from os import scandir
+from os import utime
+from os import walk
+from uuid import uuid4
+from hashlib import sha256
+from threading import Lock
+from collections import OrderedDict
+
+CACHE_DIRECTORY = "./static/cache"
+PAGE_CACHE_DIRECTORY = "./static/page_cache"
+
+# Disk budget of the render cache in bytes, least recently used entries are evicted past it
+CACHE_MAX_BYTES = int(getenv("RENDER_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+
+# Disk budget of the single page cache in bytes
+PAGE_CACHE_MAX_BYTES = int(getenv("PAGE_CACHE_MAX_BYTES", 512 * 1024 ** 2))
+
+
+# SHA-256 of a file, read in chunks so big PDFs are never held in memory
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    digest = sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Total size in bytes of the files in a directory tree
+def directory_size(directory):
+    return sum(path.getsize(path.join(root, file)) for root, _, files in walk(directory) for file in files)
+
+
+# Hard link every file of a directory tree into target, copying where a link is not possible
+def link_tree(source, target):
+    for root, _, files in walk(source):
+        folder = path.join(target, path.relpath(root, source))
+        makedirs(folder, exist_ok=True)
+        for file in files:
+            try:
+                link(path.join(root, file), path.join(folder, file))
+            except OSError:
+                shutil.copy2(path.join(root, file), path.join(folder, file))
+
+# Number of files directly in a directory, the pages of a render
+def file_count(directory):
+    return sum(1 for name in listdir(directory) if path.isfile(path.join(directory, name)))
+
+
+class DiskCache:
+    """
+    Disk budget and least recently used order shared by the caches.
+
+    Every entry is a file or directory in the cache directory named by its
+    key. Subclasses say how big an entry is and how it is removed.
+
+    :param directory: Directory holding the cache entries.
+    :param max_bytes: Disk budget of the cache.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> size in bytes, least recently used first
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self._load()
+
+    def _load(self):
+        makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in scandir(self.directory):
+            if ".tmp-" in entry.name:
+                # Left over from a render that never finished
+                self._remove(entry.path)
+                continue
+            found.append((entry.stat().st_mtime, entry.name, self._size(entry.path)))
+        for _, key, size in sorted(found):
+            self.entries[key] = size
+            self.total_bytes += size
+
+    def _size(self, entry):
+        raise NotImplementedError
+
+    def _remove(self, entry):
+        raise NotImplementedError
+
+    def _copy(self, entry, target):
+        raise NotImplementedError
+
+    def entry_path(self, key):
+        return path.join(self.directory, key)
+
+    def staging_path(self, key):
+        """
+        Path a new entry is written to before it is committed.
+        """
+        return path.join(self.directory, f"{key}.tmp-{uuid4().hex}")
+
+    def lookup(self, key, target=None):
+        """
+        Return the path of a cached entry and mark it as recently used,
+        or None on a miss.
+
+        :param target: Optional path the entry is copied to, it is returned instead of the
+            entry. The copy is made before the entry can be evicted, and eviction never
+            touches it.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            entry = self.entry_path(key)
+            utime(entry)  # Keeps the LRU order across restarts
+            if target is not None:
+                self._copy(entry, target)
+                return target
+        return entry
+
+    def commit(self, key, staging, target=None):
+        """
+        Move a finished entry into the cache and evict past the disk budget.
+
+        :param target: Optional path the entry is copied to, as in lookup.
+        :return: The path of the cache entry, or target when given.
+        """
+        entry = self.entry_path(key)
+        size = self._size(staging)
+        with self.lock:
+            if key in self.entries:
+                # Someone else rendered the same thing first
+                self._remove(staging)
+                self.entries.move_to_end(key)
+                evicted = []
+            else:
+                replace(staging, entry)
+                self.entries[key] = size
+                self.total_bytes += size
+                evicted = self._evict()
+            if target is not None:
+                self._copy(entry, target)
+        for key in evicted:
+            self._remove(self.entry_path(key))
+        return target if target is not None else entry
+
+    def discard(self, staging):
+        self._remove(staging)
+
+    def _evict(self):
+        evicted = []
+        # The newest entry always stays, even when it alone is over the budget
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            evicted.append(key)
+        return evicted
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "entries": len(self.entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class RenderCache(DiskCache):
+    """
+    Content addressed cache of rendered PDFs.
+
+    Every entry is a directory named after the PDF hash and the render
+    settings, entries are evicted least recently used first once the
+    cache grows past max_bytes. Jobs get hard links of an entry in their
+    own output folder, so evicting it never removes the images of a job.
+    """
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_bytes=CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def _size(self, entry):
+        return directory_size(entry)
+
+    def _remove(self, entry):
+        shutil.rmtree(entry, ignore_errors=True)
+
+    def _copy(self, entry, target):
+        # Hard links cost no space and leave the job's images in place when the entry is evicted
+        link_tree(entry, target)
+
+    @staticmethod
+    def key(pdf_hash, dpi, options, start_count):
+        return f"{pdf_hash}-{dpi}-{options.tag()}-{start_count}"
+
+
+class PageCache(DiskCache):
+    """
+    Cache of single rendered pages, every entry is one image file.
+    """
+
+    def __init__(self, directory=PAGE_CACHE_DIRECTORY, max_bytes=PAGE_CACHE_MAX_BYTES):
+        super().__init__(directory, max_bytes)
+
+    def _size(self, entry):
+        return directory_size(entry) if path.isdir(entry) else path.getsize(entry)
+
+    def _remove(self, entry):
+        if path.isdir(entry):
+            # Staging directory of a render
+            shutil.rmtree(entry, ignore_errors=True)
+            return
+        try:
+            remove(entry)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def key(doc_id, page, dpi, options):
+        return f"{doc_id}-{page}-{dpi}-{options.tag()}.{options.extension}"
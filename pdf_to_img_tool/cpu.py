@@ -1,5 +1,17 @@
 import psutil
-from time import sleep
+
+from os import getenv
+from time import perf_counter
+from threading import Thread, Event
+from collections import deque
+
+# Seconds between two samples of a job
+SAMPLE_INTERVAL = float(getenv("SAMPLE_INTERVAL", 0.5))
+
+# Samples kept per job, older ones are dropped
+SAMPLE_BUFFER = int(getenv("SAMPLE_BUFFER", 600))
+
+
 def get_free_cpu_count():
     # Get the total number of logical CPUs
     total_cpus = psutil.cpu_count(logical=True)
@@ -11,12 +23,133 @@ def get_free_cpu_count():
     free_cpus = total_cpus - busy_cpus
     return total_cpus, busy_cpus, free_cpus
 
-def cpu_check(stop_event):
-    while not stop_event.is_set():  # Check if the stop event is set
-        total_cpus, busy_cpus, free_cpus = get_free_cpu_count()
-        print(f" Total CPUs: {total_cpus},\n Busy CPUs: {busy_cpus:.2f},\n Free CPUs: {free_cpus:.2f}")
-        print('*'*66)
-        sleep(1)  # Wait for 1 second before checking again
+def get_free_cpu_count_nowait(busy_own=0):
+    """
+    Non blocking get_free_cpu_count from the 1 minute load average.
+
+    :param busy_own: CPUs handed to our own renders, they count as busy even
+        before they show up in the load average.
+    """
+    total_cpus = psutil.cpu_count(logical=True)
+    busy_cpus = min(total_cpus, max(psutil.getloadavg()[0], busy_own))
+    return total_cpus, busy_cpus, total_cpus - busy_cpus
+
+# Resident memory of the given processes and all their children (poppler runs as a child)
+def processes_rss(pids):
+    rss = 0
+    for pid in pids:
+        try:
+            process = psutil.Process(pid)
+            rss += process.memory_info().rss
+            rss += sum(child.memory_info().rss for child in process.children(recursive=True))
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue  # Worker exited between listing and reading it
+    return rss
+
+# CPU seconds used by the given processes and all their children, poppler runs that
+# already exited are in the children times of the worker that waited for them
+def processes_cpu_time(pids):
+    seconds = 0.0
+    for pid in pids:
+        try:
+            process = psutil.Process(pid)
+            times = process.cpu_times()
+            seconds += times.user + times.system + times.children_user + times.children_system
+            for child in process.children(recursive=True):
+                times = child.cpu_times()
+                seconds += times.user + times.system
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            continue  # Worker exited between listing and reading it
+    return seconds
+
+# Kill a process and everything it started, children first so none is left orphaned
+def kill_process_tree(pid):
+    try:
+        process = psutil.Process(pid)
+        processes = process.children(recursive=True) + [process]
+    except psutil.NoSuchProcess:
+        return
+    for process in processes:
+        try:
+            process.kill()
+        except psutil.NoSuchProcess:
+            continue
+    psutil.wait_procs(processes, timeout=5)
+
+
+class ResourceSampler:
+    """
+    Samples CPU, worker memory and page counters of a job into a ring buffer.
+
+    cpu_percent is the CPU time the job's workers and their poppler processes
+    used since the previous sample, over the time between the two, so other
+    jobs and other samplers do not show up in it. 100 is one core busy.
+
+    :param job: Job with pages_rendered, pages_encoded and worker_pids().
+    :param interval: Seconds between two samples.
+    :param size: Number of samples kept.
+    """
+
+    def __init__(self, job, interval=SAMPLE_INTERVAL, size=SAMPLE_BUFFER):
+        self.job = job
+        self.interval = interval
+        self.samples = deque(maxlen=size)
+        self.stop_event = Event()
+        self.thread = Thread(target=self._run, name=f"sampler-{job.id}", daemon=True)
+        self.started = None
+        self.last = None
+
+    def start(self):
+        self.started = perf_counter()
+        self.last = (self.started, processes_cpu_time(self.job.worker_pids()))
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(timeout=self.interval + 1)
+        self.samples.append(self.sample())
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            self.samples.append(self.sample())
+
+    def cpu_percent(self):
+        now, cpu_time = perf_counter(), processes_cpu_time(self.job.worker_pids())
+        last_now, last_cpu_time = self.last
+        self.last = (now, cpu_time)
+        if now <= last_now:
+            return 0.0
+        # Workers replaced by a new pool take their CPU time with them, never report less than 0
+        return round(max(0.0, cpu_time - last_cpu_time) / (now - last_now) * 100, 1)
+
+    def sample(self):
+        return {
+            "t": round(perf_counter() - self.started, 3),
+            "cpu_percent": self.cpu_percent(),
+            "rss": processes_rss(self.job.worker_pids()),
+            "pages_rendered": self.job.pages_rendered,
+            "pages_encoded": self.job.pages_encoded,
+        }
+
+    def to_list(self):
+        return list(self.samples)
+
+    def summary(self):
+        samples = self.to_list()
+        if not samples:
+            return {"samples": 0}
+        cpu = [sample["cpu_percent"] for sample in samples]
+        duration = samples[-1]["t"]
+        return {
+            "samples": len(samples),
+            "interval": self.interval,
+            "duration": duration,
+            "cpu_percent_avg": round(sum(cpu) / len(cpu), 2),
+            "cpu_percent_max": max(cpu),
+            "rss_peak": max(sample["rss"] for sample in samples),
+            "pages_per_sec": round(samples[-1]["pages_encoded"] / duration, 2) if duration else 0.0,
+        }
+
 
 if __name__ == "__main__":
     total, busy, free = get_free_cpu_count()
@@ -0,0 +1,280 @@
+import shutil
+
+from os import path
+from os import getenv
+from time import time
+from time import perf_counter
+from uuid import uuid4
+from threading import Event
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cpu import ResourceSampler
+from cache import RenderCache
+from cache import file_sha256
+from cache import file_count
+from util import NUM_CPUS
+from util import output_dir
+from util import DEFAULT_OPTIONS
+from util import pdf_page_count
+from util import pdf_to_images_chunked
+from util import ConversionTimeout
+from util import ConversionCancelled
+from scheduler import ConversionScheduler
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+TIMED_OUT = "timeout"
+
+# Wall clock seconds a conversion may render before it is killed, 0 for no limit
+JOB_TIMEOUT = float(getenv("JOB_TIMEOUT", 600))
+
+# Seconds a finished job, its samples and its images are kept
+JOB_TTL = float(getenv("JOB_TTL", 3600))
+
+# Most finished jobs kept, the oldest are dropped first
+MAX_FINISHED_JOBS = int(getenv("MAX_FINISHED_JOBS", 200))
+
+
+class Job:
+    def __init__(self, pdf_file, start_count=1, options=DEFAULT_OPTIONS, pdf_hash=None):
+        self.id = uuid4().hex
+        self.pdf_file = pdf_file
+        self.pdf_hash = pdf_hash
+        self.timeout = JOB_TIMEOUT
+        self.cancel_event = Event()
+        self.start_count = start_count
+        self.status = QUEUED
+        self.pages_total = 0
+        self.pages_done = 0
+        self.pages_rendered = 0
+        self.pages_encoded = 0
+        self.render_time = 0.0
+        self.encode_time = 0.0
+        self.created_at = time()
+        self.started = None
+        self.finished_at = None
+        self.elapsed = 0.0
+        self.error = None
+        self.dpi = 300
+        self.options = options
+        self.cached = False
+        self.output_path = None
+        self.workers = 0
+        self.pool = None
+        self.sampler = None
+        self.metrics = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED, TIMED_OUT)
+
+    def start(self):
+        self.status = RUNNING
+        self.started = perf_counter()
+        self.sampler = ResourceSampler(self)
+        self.sampler.start()
+
+    def remaining(self):
+        """
+        Seconds left of the time limit, None without one, raises ConversionTimeout past it.
+        """
+        if not self.timeout:
+            return None
+        remaining = self.timeout - (perf_counter() - self.started)
+        if remaining <= 0:
+            raise ConversionTimeout(f"Job took longer than {self.timeout} seconds")
+        return remaining
+
+    def advance(self, pages, render_time=0.0, encode_time=0.0):
+        self.pages_done += pages
+        self.render_time += render_time
+        self.encode_time += encode_time
+        self.elapsed = perf_counter() - self.started
+
+    def stage(self, stage, pages):
+        # Workers report rendering and encoding as they go, a range is only done once both are
+        if stage == "rendered":
+            self.pages_rendered += pages
+        else:
+            self.pages_encoded += pages
+
+    def set_pool(self, pool):
+        self.pool = pool
+
+    def worker_pids(self):
+        # ProcessPoolExecutor keeps its worker processes by pid
+        processes = getattr(self.pool, "_processes", None) or {}
+        return list(processes)
+
+    def to_dict(self):
+        pages_per_sec = self.pages_done / self.elapsed if self.elapsed else 0.0
+        eta = None
+        if self.status == RUNNING and pages_per_sec:
+            eta = round((self.pages_total - self.pages_done) / pages_per_sec, 2)
+        return {
+            "id": self.id,
+            "status": self.status,
+            "pages_total": self.pages_total,
+            "pages_done": self.pages_done,
+            "pages_per_sec": round(pages_per_sec, 2),
+            "eta": eta,
+            "time": round(self.elapsed, 5),
+            "error": self.error,
+            "cached": self.cached,
+            "workers": self.workers,
+            "output": self.output_path,
+            "metrics": self.metrics,
+        }
+
+
+class JobManager:
+    """
+    Runs PDF conversions in the background.
+
+    Render workers come from a ConversionScheduler shared by all jobs, so
+    concurrent uploads never oversubscribe the machine.
+
+    :param max_workers: Most worker processes a single conversion asks for.
+    :param cache: RenderCache that finished renders are looked up in and stored to.
+    :param scheduler: ConversionScheduler that admits jobs and hands out workers.
+    :param ttl: Seconds a finished job is kept.
+    :param max_finished: Most finished jobs kept.
+    """
+
+    def __init__(self, max_workers=NUM_CPUS, cache=None, scheduler=None, ttl=JOB_TTL, max_finished=MAX_FINISHED_JOBS):
+        self.max_workers = max_workers
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self.cache = cache if cache is not None else RenderCache()
+        self.scheduler = scheduler if scheduler is not None else ConversionScheduler()
+        self.jobs = {}
+        # One thread per admitted job, waiting jobs block in scheduler.acquire
+        self.executor = ThreadPoolExecutor(max_workers=self.scheduler.max_pending, thread_name_prefix="pdf-job")
+
+    def submit(self, pdf_file, start_count=1, options=DEFAULT_OPTIONS, pdf_hash=None, timeout=None):
+        """
+        Queue a conversion, raises SchedulerSaturated when too many jobs are pending.
+
+        :param pdf_hash: SHA-256 of the PDF when already known, saves hashing it again.
+        :param timeout: Wall clock seconds the render may take, defaults to JOB_TIMEOUT.
+        """
+        self.scheduler.admit()
+        self.prune()
+        job = Job(pdf_file, start_count, options, pdf_hash)
+        if timeout is not None:
+            job.timeout = timeout
+        self.jobs[job.id] = job
+        self.executor.submit(self._run, job)
+        return job
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def cancel(self, job):
+        """
+        Stop a job, a running render is killed and a queued job never starts.
+        """
+        job.cancel_event.set()
+        self.scheduler.wake()
+
+    def prune(self):
+        """
+        Forget finished jobs past the TTL and the oldest past max_finished, removing their images.
+        """
+        finished = sorted((job for job in list(self.jobs.values()) if job.finished_at is not None),
+                          key=lambda job: job.finished_at)
+        expired = len(finished) - self.max_finished
+        now = time()
+        for number, job in enumerate(finished):
+            if number >= expired and now - job.finished_at < self.ttl:
+                break
+            self.jobs.pop(job.id, None)
+            # Only the job's own folder, the render cache keeps its copy
+            shutil.rmtree(path.dirname(self.output_path(job)), ignore_errors=True)
+
+    def running(self):
+        return [job for job in list(self.jobs.values()) if job.status == RUNNING]
+
+    def _run(self, job):
+        try:
+            if job.pdf_hash is None:
+                job.pdf_hash = file_sha256(job.pdf_file)
+            key = self.cache.key(job.pdf_hash, job.dpi, job.options, job.start_count)
+            job.output_path = self.cache.lookup(key, self.output_path(job))
+            if job.output_path is not None:
+                job.start()
+                job.cached = True
+                job.pages_total = file_count(job.output_path)
+                job.stage("rendered", job.pages_total)
+                job.stage("encoded", job.pages_total)
+                job.advance(job.pages_total)
+            else:
+                job.workers = self.scheduler.acquire(self.max_workers, job.cancel_event)
+                try:
+                    if job.cancel_event.is_set():
+                        raise ConversionCancelled("Job was cancelled before it started")
+                    job.start()
+                    self._render(job, key)
+                finally:
+                    self.scheduler.release(job.workers)
+        except ConversionCancelled as e:
+            print(f"Job {job.id} stopped: {e}")
+            self._finish(job)
+            job.error = str(e)
+            job.status = TIMED_OUT if isinstance(e, ConversionTimeout) else CANCELLED
+        except Exception as e:
+            print(f"Job {job.id} failed: {e}")
+            self._finish(job)
+            job.error = str(e)
+            job.status = FAILED
+        else:
+            self._finish(job)
+            job.status = DONE
+        finally:
+            job.finished_at = time()
+            self.scheduler.done()
+
+    @staticmethod
+    def output_path(job):
+        """
+        Folder the images of a job are linked into, output_dir/<job id>/<pdf name>.
+
+        The render cache keeps its own copy, evicting it leaves this one alone.
+        """
+        return path.join(output_dir, job.id, path.splitext(path.basename(job.pdf_file))[0])
+
+    def _finish(self, job):
+        if job.sampler is None:
+            # Failed before it started
+            job.metrics = {"samples": 0}
+            return
+        job.elapsed = perf_counter() - job.started
+        job.sampler.stop()
+        job.pool = None
+        job.metrics = job.sampler.summary()
+        job.metrics["render_time"] = round(job.render_time, 3)
+        job.metrics["encode_time"] = round(job.encode_time, 3)
+
+    def _render(self, job, key):
+        # The page count and the render share the job's time limit
+        job.pages_total = pdf_page_count(job.pdf_file, job.remaining())
+        if job.cancel_event.is_set():
+            raise ConversionCancelled("Job was cancelled before it started")
+        staging = self.cache.staging_path(key)
+        try:
+            pdf_to_images_chunked(job.pdf_file, start_count=job.start_count, dpi=job.dpi, options=job.options,
+                                  max_workers=job.workers, progress=job.advance, on_stage=job.stage,
+                                  output_path=staging, on_pool=job.set_pool, cancel_event=job.cancel_event,
+                                  timeout=job.remaining(), total_pages=job.pages_total)
+        except Exception:
+            # Partial output of a failed, cancelled or timed out render
+            self.cache.discard(staging)
+            raise
+        job.output_path = self.cache.commit(key, staging, self.output_path(job))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,5 +1,12 @@
+import re
+import json
+import shutil
+import asyncio
+
 from os import path
 from os import makedirs
+from uuid import uuid4
+from urllib.parse import quote
 
 from uvicorn import run
 from fastapi import FastAPI
@@ -9,26 +16,44 @@ from fastapi import Request
 # from fastapi import red
 from fastapi import Form
 from fastapi import Path
+from fastapi import Query
 
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse
 from fastapi.responses import RedirectResponse
+from fastapi.responses import StreamingResponse
 from fastapi.templating import Jinja2Templates
+from starlette.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 
-from time import perf_counter
-from threading import Thread,Event
-from cpu import get_free_cpu_count, cpu_check
-from util import NUM_CPUS
-from util import pdf_to_images_multiprocessing
+from jobs import DONE
+from jobs import JobManager
+from archive import iter_zip
+from pages import PageRenderer
+from pages import PageOutOfRange
+from pages import DocumentNotFound
+from pages import InvalidDocument
+from scheduler import SchedulerSaturated
+from uploads import save_upload
+from uploads import UploadTooLarge
+from util import ImageOptions
+from util import IMAGE_FORMATS
 UPLOAD_DIRECTORY = "./static/output"
 
+# Image number given to the first page of an uploaded PDF
+START_COUNT = 1184
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.mount("/static/output", StaticFiles(directory="static/output"), name="output")
 
 templates = Jinja2Templates(directory="templates")
 
+job_manager = JobManager()
+page_renderer = PageRenderer()
+
 origins_urls = [
     "http://localhost",
     "http://localhost:8080",
@@ -44,6 +69,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Characters left out of the plain filename of a download, they go in filename* only
+UNSAFE_FILENAME = re.compile(r"[^\w .-]", re.ASCII)
+
+# Content-Disposition of a download, an ASCII filename for old clients and the real name as RFC 5987 filename*
+def attachment(file_name):
+    fallback = UNSAFE_FILENAME.sub("_", file_name)
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(file_name, safe='')}"
+
 @app.get("/", response_class=HTMLResponse)
 async def read_item(request: Request, msg: str = None):
     """
@@ -58,46 +91,168 @@ def select_folder(folder_path: str = Form(...)):
     print(f"Selected folder: {folder_path}")  # Display on console
     return {"folder_path": folder_path}
 
+@app.on_event("shutdown")
+def shutdown_jobs():
+    job_manager.shutdown()
+    page_renderer.shutdown()
+
 @app.post("/upload_file", response_class=HTMLResponse)
-async def upload_pdf_file(request: Request, pdf_file: UploadFile):
+async def upload_pdf_file(request: Request, pdf_file: UploadFile, fmt: str = Form("png"),
+                          color_mode: str = Form("RGB"), quality: int = Form(95), compress_level: int = Form(6),
+                          thumbnail: int = Form(0)):
+    """
+    Save the PDF and queue its conversion, the page returns at once and
+    follows the job progress over /jobs/{job_id}/events.
+    """
     if pdf_file.content_type != "application/pdf":
         # raise HTTPException(status_code=400, detail="Only PDF files are supported!")
         return RedirectResponse(url="/?msg=Only PDF files are supported", status_code=302)
+    try:
+        options = ImageOptions(fmt=fmt, quality=quality, compress_level=compress_level, color_mode=color_mode,
+                               thumbnail=(thumbnail, thumbnail) if thumbnail else None)
+    except ValueError as e:
+        return RedirectResponse(url=f"/?msg={quote(str(e))}", status_code=302)
+
+    try:
+        # Reject before the upload is written when the machine is already saturated
+        job_manager.scheduler.check()
+    except SchedulerSaturated as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
 
-    file_name = pdf_file.filename
-    file_path = path.join(UPLOAD_DIRECTORY, file_name)
+    file_name = path.basename(pdf_file.filename)
+    # A folder per upload, a second upload of the same name never overwrites a PDF still being rendered
+    file_path = path.join(UPLOAD_DIRECTORY, uuid4().hex, file_name)
 
     makedirs(path.dirname(file_path), exist_ok=True)
-    time =None
     try:
-        with open(file_path, "wb+") as buffer:
-            buffer.write(await pdf_file.read())
-        stop_event = Event()
-
-        # Start CPU monitoring in a separate thread
-        cpu_monitor_thread = Thread(target=cpu_check, args=(stop_event,))
-        
-        # Create a threading event to signal when to stop the CPU monitoring
-        cpu_monitor_thread.daemon = True  # This allows the thread to exit when the main program does
-        cpu_monitor_thread.start()
-       
-        time_start = perf_counter()
-        pdf_to_images_multiprocessing(pdf_file= file_path, start_count=1184,max_workers=NUM_CPUS)
-        time_end = perf_counter()
-
-        # Signal the CPU monitoring thread to stop
-        stop_event.set()
-
-        # Optionally, wait for the monitoring thread to finish (not necessary as it's a daemon thread)
-        cpu_monitor_thread.join(timeout=1)       
-        time = f"{time_end-time_start:.5f}"
-        print(f"{time=:}")
-    except Exception as e:
-        print("except", e)
-        
-    else:
-        print("done convertion")
-    return templates.TemplateResponse("display.html", {"request": request, "msg": "file convert into image", "time": time})
+        _, pdf_hash = await save_upload(pdf_file, file_path)
+    except UploadTooLarge as e:
+        shutil.rmtree(path.dirname(file_path), ignore_errors=True)
+        raise HTTPException(status_code=413, detail=str(e))
+
+    try:
+        job = job_manager.submit(file_path, start_count=START_COUNT, options=options, pdf_hash=pdf_hash)
+    except SchedulerSaturated as e:
+        # Saturated while the upload was written, no job will ever read it
+        shutil.rmtree(path.dirname(file_path), ignore_errors=True)
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    if "application/json" in request.headers.get("accept", ""):
+        return JSONResponse(job.to_dict(), status_code=202)
+    return templates.TemplateResponse("display.html", {"request": request, "msg": "file queued for conversion", "job": job})
+
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+@app.get("/cache")
+def cache_stats():
+    return job_manager.cache.stats()
+
+@app.get("/scheduler")
+def scheduler_stats():
+    return job_manager.scheduler.stats()
+
+@app.get("/metrics")
+def metrics():
+    """
+    Resource samples of every running job, finished jobs keep a summary in /jobs/{job_id}.
+    """
+    return {"jobs": {job.id: job.sampler.to_list() for job in job_manager.running() if job.sampler}}
+
+@app.get("/jobs/{job_id}/metrics")
+def job_metrics(job_id: str = Path(...)):
+    job = get_job(job_id)
+    return {"samples": job.sampler.to_list() if job.sampler else [], "summary": job.metrics}
+
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str = Path(...)):
+    return get_job(job_id).to_dict()
+
+@app.post("/jobs/{job_id}/cancel")
+def job_cancel(job_id: str = Path(...)):
+    """
+    Cancel a queued or running job, its poppler and worker processes are killed
+    and the partial output removed.
+    """
+    job = get_job(job_id)
+    if job.finished:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    job_manager.cancel(job)
+    return {"id": job.id, "cancelling": True}
+
+@app.get("/jobs/{job_id}/download")
+def job_download(job_id: str = Path(...)):
+    """
+    Stream the images of a finished job as a ZIP, built while it is sent.
+    """
+    job = get_job(job_id)
+    if job.status != DONE:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}")
+    if not path.isdir(job.output_path):
+        # The render cache evicted the images since the job finished
+        raise HTTPException(status_code=410, detail="Images of this job are no longer available")
+    file_name = path.splitext(path.basename(job.pdf_file))[0]
+    return StreamingResponse(iter_zip(job.output_path), media_type="application/zip",
+                             headers={"Content-Disposition": attachment(f"{file_name}.zip")})
+
+@app.get("/jobs/{job_id}/events")
+async def job_events(request: Request, job_id: str = Path(...)):
+    """
+    Server-Sent Events stream of the job progress, one event per change.
+    """
+    job = get_job(job_id)
+
+    async def stream():
+        last = None
+        while not await request.is_disconnected():
+            data = json.dumps(job.to_dict())
+            if data != last:
+                yield f"data: {data}\n\n"
+                last = data
+            if job.finished:
+                break
+            await asyncio.sleep(0.5)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post("/pdf")
+async def upload_document(pdf_file: UploadFile):
+    """
+    Store a PDF without rendering it, pages are rendered on request by /pdf/{doc_id}/page/{page}.
+    """
+    if pdf_file.content_type != "application/pdf":
+        raise HTTPException(status_code=400, detail="Only PDF files are supported!")
+    file_path = page_renderer.upload_path()
+    try:
+        _, pdf_hash = await save_upload(pdf_file, file_path)
+    except UploadTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    try:
+        doc_id, pages = await run_in_threadpool(page_renderer.add_document, file_path, pdf_hash)
+    except InvalidDocument as e:
+        raise HTTPException(status_code=400, detail=f"Not a readable PDF: {e}")
+    return {"doc_id": doc_id, "pages": pages, "first_page": f"/pdf/{doc_id}/page/1"}
+
+@app.get("/pdf/{doc_id}/page/{page}")
+async def document_page(doc_id: str, page: int = Path(..., ge=1), dpi: int = Query(150, ge=36, le=600),
+                        fmt: str = Query("png")):
+    """
+    One page of a stored PDF, rendered on first access and cached, the next pages are prefetched.
+    """
+    if fmt not in IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unsupported format {fmt}")
+    options = ImageOptions(fmt=fmt)
+    try:
+        # Reading the page count may run pdfinfo the first time
+        future = await run_in_threadpool(page_renderer.get_page, doc_id, page, dpi, options)
+    except DocumentNotFound:
+        raise HTTPException(status_code=404, detail="Document not found")
+    except PageOutOfRange as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    image_path = await asyncio.wrap_future(future)
+    return FileResponse(image_path, media_type=f"image/{fmt}")
 
 if __name__ == "__main__":
     run("main:app", host="0.0.0.0", port=8001, reload=True)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import re
+import shutil
+
+from os import path
+from os import getenv
+from os import makedirs
+from os import remove
+from os import replace
+from uuid import uuid4
+from threading import RLock
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+
+from pdf2image.exceptions import PDFPageCountError
+
+from cache import PageCache
+from util import pdf_page_count
+from util import render_page_range
+
+DOCS_DIRECTORY = "./static/docs"
+
+# Pages rendered at the same time for the page endpoint
+PAGE_RENDER_WORKERS = int(getenv("PAGE_RENDER_WORKERS", 2))
+
+# Pages after the requested one rendered in the background
+PREFETCH_PAGES = int(getenv("PREFETCH_PAGES", 3))
+
+DOC_ID = re.compile(r"^[0-9a-f]{64}$")
+
+
+class DocumentNotFound(Exception):
+    pass
+
+
+class PageOutOfRange(Exception):
+    pass
+
+
+class InvalidDocument(Exception):
+    pass
+
+
+class PageRenderer:
+    """
+    Renders single pages of stored PDFs on first access.
+
+    Documents are stored under their SHA-256, pages go into a bounded
+    PageCache and the following pages are rendered in the background so
+    paging through a document rarely waits on poppler. Prefetches run on a
+    single worker of their own, a requested page never queues behind them.
+
+    :param cache: PageCache rendered pages are kept in.
+    :param workers: Pages rendered at the same time.
+    :param prefetch: Pages after the requested one rendered in the background.
+    """
+
+    def __init__(self, cache=None, workers=PAGE_RENDER_WORKERS, prefetch=PREFETCH_PAGES, directory=DOCS_DIRECTORY):
+        self.cache = cache if cache is not None else PageCache()
+        self.prefetch = prefetch
+        self.directory = directory
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-page")
+        self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="pdf-prefetch")
+        self.page_counts = {}
+        self.in_flight = {}  # cache key -> (Future of the render, True for a prefetch)
+        # Reentrant, cancelling a queued prefetch calls _forget right away
+        self.lock = RLock()
+        makedirs(self.directory, exist_ok=True)
+
+    def document_path(self, doc_id):
+        file_path = path.join(self.directory, f"{doc_id}.pdf")
+        if not DOC_ID.match(doc_id) or not path.exists(file_path):
+            raise DocumentNotFound(doc_id)
+        return file_path
+
+    def upload_path(self):
+        """
+        Temporary path an upload is written to before add_document.
+        """
+        return path.join(self.directory, f"upload.tmp-{uuid4().hex}")
+
+    def add_document(self, file_path, pdf_hash):
+        """
+        Move a PDF into the store under its hash, a copy already stored wins.
+
+        The page count is read before the file is stored, a file pdfinfo
+        cannot read is deleted and raises InvalidDocument.
+
+        :return: The document id and its page count.
+        """
+        doc_path = path.join(self.directory, f"{pdf_hash}.pdf")
+        if path.exists(doc_path):
+            remove(file_path)
+            return pdf_hash, self.page_count(pdf_hash)
+        try:
+            pages = pdf_page_count(file_path)
+        except PDFPageCountError as e:
+            remove(file_path)
+            raise InvalidDocument(str(e))
+        replace(file_path, doc_path)
+        self.page_counts[pdf_hash] = pages
+        return pdf_hash, pages
+
+    def page_count(self, doc_id):
+        if doc_id not in self.page_counts:
+            self.page_counts[doc_id] = pdf_page_count(self.document_path(doc_id))
+        return self.page_counts[doc_id]
+
+    def get_page(self, doc_id, page, dpi, options):
+        """
+        Future of the path of a rendered page, done at once when it is cached.
+        """
+        pages = self.page_count(doc_id)
+        if not 1 <= page <= pages:
+            raise PageOutOfRange(f"Page {page} is out of range 1-{pages}")
+        future = self._submit(doc_id, page, dpi, options)
+        for next_page in range(page + 1, min(page + self.prefetch, pages) + 1):
+            self._submit(doc_id, next_page, dpi, options, prefetch=True)
+        return future
+
+    def _submit(self, doc_id, page, dpi, options, prefetch=False):
+        key = self.cache.key(doc_id, page, dpi, options)
+        with self.lock:
+            if key in self.in_flight:
+                future, prefetched = self.in_flight[key]
+                # A prefetch still queued is dropped and the page rendered as a request instead
+                if prefetch or not prefetched or not future.cancel():
+                    return future
+            cached = self.cache.lookup(key)
+            if cached is not None:
+                future = Future()
+                future.set_result(cached)
+                return future
+            executor = self.prefetcher if prefetch else self.executor
+            future = executor.submit(self._render, doc_id, page, dpi, options, key)
+            self.in_flight[key] = (future, prefetch)
+        future.add_done_callback(lambda done: self._forget(key, done))
+        return future
+
+    def _forget(self, key, future):
+        with self.lock:
+            if self.in_flight.get(key, (None,))[0] is future:
+                del self.in_flight[key]
+
+    def _render(self, doc_id, page, dpi, options, key):
+        staging = self.cache.staging_path(key)
+        makedirs(staging)
+        try:
+            render_page_range(self.document_path(doc_id), staging, page, page, 1, dpi, options)
+            staging_file = self.cache.staging_path(key)
+            replace(path.join(staging, f"I{page}.{options.extension}"), staging_file)
+            return self.cache.commit(key, staging_file)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
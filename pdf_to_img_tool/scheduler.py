@@ -0,0 +1,99 @@
+from os import getenv
+from math import floor
+from threading import Condition
+
+from cpu import get_free_cpu_count_nowait
+from util import NUM_CPUS
+
+# Render worker processes allowed at the same time across all jobs
+MAX_RENDERS = int(getenv("MAX_RENDERS", NUM_CPUS))
+
+# Jobs admitted (running or waiting for workers) before new ones are rejected
+MAX_PENDING_JOBS = int(getenv("MAX_PENDING_JOBS", 8))
+
+# Seconds a rejected client is told to wait before trying again
+RETRY_AFTER = int(getenv("RETRY_AFTER", 30))
+
+
+class SchedulerSaturated(Exception):
+    def __init__(self, retry_after=RETRY_AFTER):
+        super().__init__("Too many conversions queued, try again later")
+        self.retry_after = retry_after
+
+
+class ConversionScheduler:
+    """
+    Machine wide budget of render workers shared by all conversion jobs.
+
+    A job is admitted while fewer than max_pending jobs are in the system,
+    then waits until workers are free. Each job gets as many workers as the
+    budget and the current CPU load allow, and at least one.
+
+    :param max_renders: Worker processes allowed at the same time.
+    :param max_pending: Jobs running or waiting before new ones are rejected.
+    :param retry_after: Seconds given to rejected clients in Retry-After.
+    """
+
+    def __init__(self, max_renders=MAX_RENDERS, max_pending=MAX_PENDING_JOBS, retry_after=RETRY_AFTER):
+        self.max_renders = max_renders
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.condition = Condition()
+        self.in_use = 0
+        self.pending = 0
+        self.rejected = 0
+
+    def check(self):
+        """
+        Raise SchedulerSaturated when a new job would be rejected, reserves nothing.
+        """
+        with self.condition:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise SchedulerSaturated(self.retry_after)
+
+    def admit(self):
+        with self.condition:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise SchedulerSaturated(self.retry_after)
+            self.pending += 1
+
+    def done(self):
+        with self.condition:
+            self.pending -= 1
+
+    def acquire(self, wanted, cancel_event=None):
+        """
+        Block until at least one worker is free and return how many the job gets,
+        or 0 when cancel_event is set while waiting.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_use < self.max_renders
+                                    or (cancel_event is not None and cancel_event.is_set()))
+            if cancel_event is not None and cancel_event.is_set():
+                return 0
+            _, _, free_cpus = get_free_cpu_count_nowait(busy_own=self.in_use)
+            granted = min(wanted, self.max_renders - self.in_use, max(floor(free_cpus), 1))
+            self.in_use += granted
+            return granted
+
+    def release(self, granted):
+        with self.condition:
+            self.in_use -= granted
+            self.condition.notify_all()
+
+    def wake(self):
+        # Lets waiting jobs see that they were cancelled
+        with self.condition:
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "workers_in_use": self.in_use,
+                "max_renders": self.max_renders,
+                "pending_jobs": self.pending,
+                "max_pending_jobs": self.max_pending,
+                "rejected": self.rejected,
+            }
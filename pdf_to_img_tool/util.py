@@ -1,13 +1,26 @@
 from os import path
 from os import walk
 from os import makedirs
+from os import replace
 
 import multiprocessing
 
+from time import perf_counter
+from uuid import uuid4
+from queue import Empty
+from dataclasses import dataclass
+
 from pdf2image import convert_from_path
+from pdf2image import pdfinfo_from_path
+from pdf2image.exceptions import PDFPopplerTimeoutError
 
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+from concurrent.futures import FIRST_COMPLETED
+
+from cpu import kill_process_tree
 
 output_dir = "./static/output_images"
 
@@ -16,6 +29,25 @@ POPPLER_PATH = r"C:\Users\Bindra\Downloads\Documents\Release-24.02.0-0\poppler-2
 
 NUM_CPUS = multiprocessing.cpu_count()
 
+# Pages rendered by one worker at a time, peak memory per worker is bounded by this
+CHUNK_SIZE = 8
+
+# Seconds between two checks for a cancel or timeout while ranges are rendering
+CANCEL_POLL_INTERVAL = 0.25
+
+
+# Queue a worker of pdf_to_images_chunked reports its stages on, set by _init_worker
+_stages = None
+
+
+class ConversionCancelled(Exception):
+    pass
+
+
+class ConversionTimeout(ConversionCancelled):
+    pass
+
+
 # Find all PDF files in the given directory
 def find_pdfs(directory):
     pdf_files = []
@@ -25,15 +57,131 @@ def find_pdfs(directory):
                 pdf_files.append(path.join(root, file))
     return pdf_files
 
+# Pillow format name and file extension of every supported output format
+IMAGE_FORMATS = {
+    "png": ("PNG", "png"),
+    "jpeg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+}
+
+# RGB colour, L grayscale, 1 for 1-bit black and white (scanned text)
+COLOR_MODES = ("RGB", "L", "1")
+
+THUMBNAIL_DIRECTORY = "thumbnails"
+
+
+@dataclass(frozen=True)
+class ImageOptions:
+    """
+    How rendered pages are encoded.
+
+    :param fmt: Output format, one of IMAGE_FORMATS.
+    :param quality: JPEG and WebP quality (1-100), ignored by PNG.
+    :param compress_level: zlib level (0-9) for PNG, encoder effort (0-6) for WebP.
+    :param color_mode: One of COLOR_MODES.
+    :param thumbnail: Optional (width, height), also saves a thumbnail under thumbnails/.
+    :param direct: Let poppler write the files itself when it supports these options.
+    """
+    fmt: str = "png"
+    quality: int = 95
+    compress_level: int = 6
+    color_mode: str = "RGB"
+    thumbnail: tuple = None
+    direct: bool = True
+
+    def __post_init__(self):
+        if self.fmt not in IMAGE_FORMATS:
+            raise ValueError(f"Unsupported format {self.fmt}, use one of {', '.join(IMAGE_FORMATS)}")
+        if self.color_mode not in COLOR_MODES:
+            raise ValueError(f"Unsupported color mode {self.color_mode}, use one of {', '.join(COLOR_MODES)}")
+        if self.color_mode == "1" and self.fmt != "png":
+            raise ValueError("1-bit color mode is only supported with png")
+
+    @property
+    def extension(self):
+        return IMAGE_FORMATS[self.fmt][1]
+
+    @property
+    def render_direct(self):
+        """
+        True when poppler can write the final files, without decoding them into PIL and
+        encoding them again. pdftoppm writes PNG at the default zlib level and JPEG,
+        in colour or grayscale.
+        """
+        if not self.direct or self.thumbnail:
+            return False
+        if self.color_mode not in ("RGB", "L"):
+            return False
+        return self.fmt == "jpeg" or (self.fmt == "png" and self.compress_level == 6)
+
+    def save_params(self):
+        if self.fmt == "png":
+            return {"compress_level": self.compress_level}
+        if self.fmt == "webp":
+            return {"quality": self.quality, "method": min(self.compress_level, 6)}
+        return {"quality": self.quality}
+
+    def tag(self):
+        """
+        Short string naming these options, used in cache keys.
+        """
+        if self.fmt == "png":
+            level = self.compress_level
+        elif self.fmt == "webp":
+            # The encoder method changes the files as much as the quality does
+            level = f"{self.quality}m{min(self.compress_level, 6)}"
+        else:
+            level = self.quality
+        tag = f"{self.fmt}{level}-{self.color_mode}"
+        if self.thumbnail:
+            tag += f"-{self.thumbnail[0]}x{self.thumbnail[1]}"
+        return tag
+
+
+DEFAULT_OPTIONS = ImageOptions()
+
 # Save image with threading
-def save_image(image, image_path, quality=95):
-    image.save(image_path, 'PNG', quality=quality)
+def save_image(image, image_path, options=DEFAULT_OPTIONS):
+    if image.mode != options.color_mode:
+        image = image.convert(options.color_mode)
+    image.save(image_path, IMAGE_FORMATS[options.fmt][0], **options.save_params())
+    if options.thumbnail:
+        thumbnail_path = path.join(path.dirname(image_path), THUMBNAIL_DIRECTORY)
+        makedirs(thumbnail_path, exist_ok=True)
+        thumbnail = image.copy()
+        thumbnail.thumbnail(options.thumbnail)
+        thumbnail.save(path.join(thumbnail_path, path.basename(image_path)),
+                       IMAGE_FORMATS[options.fmt][0], **options.save_params())
     print(f"Image saved: {image_path}")
 
+def render_to_disk(pdf_file, file_path, first_number, dpi=300, options=DEFAULT_OPTIONS, first_page=None,
+                   last_page=None, thread_count=1):
+    """
+    Let poppler write the pages straight to file_path, then name them I{n}.
+
+    :param first_number: Image number given to the first rendered page.
+    :param first_page: First page to render, None for the whole PDF.
+    :param last_page: Last page to render, None for the whole PDF.
+    :param thread_count: Number of pdftoppm processes the pages are split across.
+    :return: Number of images saved.
+    """
+    makedirs(file_path, exist_ok=True)
+    jpegopt = {"quality": options.quality, "progressive": False, "optimize": False} if options.fmt == "jpeg" else None
+    # A unique prefix keeps the files of ranges rendered into the same folder apart
+    image_paths = convert_from_path(pdf_file, dpi=dpi, poppler_path=POPPLER_PATH, first_page=first_page,
+                                    last_page=last_page, output_folder=file_path, output_file=uuid4().hex,
+                                    paths_only=True, fmt=options.fmt, jpegopt=jpegopt,
+                                    grayscale=options.color_mode == "L", thread_count=thread_count)
+    for number, image_path in enumerate(image_paths, start=first_number):
+        replace(image_path, path.join(file_path, f"I{number}.{options.extension}"))
+    return len(image_paths)
+
 # Convert a single PDF to images and save using threading
-def process_pdf(pdf_path, start_count=0, dpi=300, quality=95, max_workers=4):
+def process_pdf(pdf_path, start_count=0, dpi=300, options=DEFAULT_OPTIONS, max_workers=4, output_path=UPLOAD_DIRECTORY):
     try:
         print(f"Converting {pdf_path} to images...")
+        if options.render_direct:
+            return render_to_disk(pdf_path, output_path, start_count + 1, dpi, options, thread_count=max_workers)
 
         images = convert_from_path(pdf_path, dpi=dpi, poppler_path=POPPLER_PATH)
         image_paths = []
@@ -41,9 +189,9 @@ def process_pdf(pdf_path, start_count=0, dpi=300, quality=95, max_workers=4):
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = []
             for i, image in enumerate(images, start=start_count):  # Start counting from start_count
-                image_path = path.join(UPLOAD_DIRECTORY, f"I{i + 1}.png")
+                image_path = path.join(output_path, f"I{i + 1}.{options.extension}")
                 image_paths.append(image_path)
-                futures.append(executor.submit(save_image, image, image_path, quality))
+                futures.append(executor.submit(save_image, image, image_path, options))
             
             for future in futures:
                 future.result()  # Ensure all threads complete
@@ -54,39 +202,73 @@ def process_pdf(pdf_path, start_count=0, dpi=300, quality=95, max_workers=4):
         print(f"Failed to convert pdf2img {pdf_path}: {e}")
         return 0
 
+# Convert a single PDF and time it, runs inside a worker process
+def process_pdf_timed(pdf_path, start_count=0, dpi=300, options=DEFAULT_OPTIONS, max_workers=4):
+    time_start = perf_counter()
+    pages = process_pdf(pdf_path, start_count, dpi, options, max_workers)
+    return pages, perf_counter() - time_start
+
 # Multiprocessing to handle multiple PDFs concurrently
-def pdfs_to_images_multiprocessing(pdf_files, max_workers=None):
-    image_counter = 0  # This will track the total number of images
+def pdfs_to_images_multiprocessing(pdf_files, max_workers=None, dpi=300, options=DEFAULT_OPTIONS):
+    """
+    Convert many PDFs to images in parallel with one global image numbering.
+
+    Page counts are read with pdfinfo before anything is rendered, so every
+    PDF knows its start_count up front and all of them can run at once.
+
+    :param pdf_files: List of PDF file paths.
+    :param options: ImageOptions the pages are encoded with.
+    :return: One dict per PDF with its start_count, page count and seconds taken.
+    """
     if max_workers is None:
         max_workers = multiprocessing.cpu_count()  # Use all available CPUs
+
+    results = []
+    image_counter = 0  # This will track the total number of images
+    for pdf in pdf_files:
+        try:
+            pages = pdf_page_count(pdf)
+        except Exception as e:
+            print(f"Failed to read page count {pdf}: {e}")
+            pages = 0
+        results.append({"pdf": pdf, "start_count": image_counter, "pages": pages, "time": 0.0})
+        image_counter += pages
+
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        results = []
-        for pdf in pdf_files:
-            # Pass the current image counter as the starting point for numbering
-            result = executor.submit(process_pdf, pdf, image_counter)
-            num_images = result.result()  # Number of images processed by the current PDF
-            image_counter += num_images  # Update the counter after each PDF
+        futures = {executor.submit(process_pdf_timed, result["pdf"], result["start_count"], dpi, options): result
+                   for result in results if result["pages"]}
+        for future in as_completed(futures):
+            result = futures[future]
+            result["pages"], result["time"] = future.result()
 
     return results
+
 # def process_page(page_number, pdf_file, output_dir, start_count=0, dpi=300, quality=95, max_workers=4):
  
 
-def pdf_to_images_multiprocessing(pdf_file, start_count = 1, dpi=300, quality=95, max_workers=None):
+def pdf_to_images_multiprocessing(pdf_file, start_count = 1, dpi=300, options=DEFAULT_OPTIONS, max_workers=None,
+                                  output_path=None):
     """
     Convert a single page of a PDF to an image and save it.
     
     :param page_number: The page number to convert.
     :param pdf_file: The PDF file path.
     :param output_dir: The directory to save images.
+    :param options: ImageOptions the pages are encoded with.
+    :param output_path: Directory to save images, defaults to output_dir/<pdf name>.
     """
     if max_workers is None:
         max_workers = multiprocessing.cpu_count()  # Use all available CPUs
     
-    file_name = path.basename(pdf_file).replace('.pdf', '')
-    file_path = path.join(output_dir, path.basename(file_name))
+    file_path = output_path
+    if file_path is None:
+        file_name = path.basename(pdf_file).replace('.pdf', '')
+        file_path = path.join(output_dir, path.basename(file_name))
     # Create a directory to save the images
     makedirs(file_path, exist_ok=True)
 
+    if options.render_direct:
+        return render_to_disk(pdf_file, file_path, start_count, dpi, options, thread_count=max_workers)
    
     # Convert the specific page to an image
     images = convert_from_path(pdf_file,  dpi=dpi, poppler_path=POPPLER_PATH )
@@ -95,9 +277,9 @@ def pdf_to_images_multiprocessing(pdf_file, start_count = 1, dpi=300, quality=95
         with ThreadPoolExecutor(max_workers=max_workers) as executor:
             futures = []
             for i, image in enumerate(images, start=start_count):
-                image_path = path.join(file_path, f"I{i}.png")
+                image_path = path.join(file_path, f"I{i}.{options.extension}")
 
-                futures.append(executor.submit(save_image, image, image_path, quality))
+                futures.append(executor.submit(save_image, image, image_path, options))
 
             for future in futures:
                 future.result()  # Ensure all threads complete
@@ -105,6 +287,142 @@ def pdf_to_images_multiprocessing(pdf_file, start_count = 1, dpi=300, quality=95
         print("Got error in Muti threading")
     return len(images) 
 
+# Number of pages in a PDF, read with pdfinfo without rendering anything, a pdfinfo
+# still running after timeout seconds is killed and ConversionTimeout is raised
+def pdf_page_count(pdf_file, timeout=None):
+    try:
+        info = pdfinfo_from_path(pdf_file, poppler_path=POPPLER_PATH, timeout=timeout)
+    except PDFPopplerTimeoutError:
+        raise ConversionTimeout(f"Reading the page count of {pdf_file} took longer than {timeout} seconds")
+    return int(info["Pages"])
+
+# Split pages 1..total_pages into (first_page, last_page) ranges of chunk_size
+def page_ranges(total_pages, chunk_size=CHUNK_SIZE):
+    return [(first, min(first + chunk_size - 1, total_pages))
+            for first in range(1, total_pages + 1, chunk_size)]
+
+def _init_worker(stages):
+    global _stages
+    _stages = stages
+
+# Tell the parent that pages went through a stage, "rendered" or "encoded"
+def _report_stage(stage, pages):
+    if _stages is not None:
+        _stages.put((stage, pages))
+
+# Pass every stage reported by the workers so far to on_stage
+def _drain_stages(stages, on_stage):
+    if stages is None:
+        return
+    while True:
+        try:
+            stage, pages = stages.get_nowait()
+        except Empty:
+            return
+        on_stage(stage, pages)
+
+def render_page_range(pdf_file, file_path, first_page, last_page, start_count=1, dpi=300, options=DEFAULT_OPTIONS):
+    """
+    Render a page range of a PDF and save it, runs inside a worker process.
+
+    :param pdf_file: The PDF file path.
+    :param file_path: The directory to save images.
+    :param first_page: First page of the range (1 based).
+    :param last_page: Last page of the range (inclusive).
+    :param start_count: Image number given to page 1 of the PDF.
+    :param options: ImageOptions the pages are encoded with.
+    :return: Number of images saved, seconds spent rendering and seconds spent encoding
+        (encoding is part of rendering when poppler writes the files).
+    """
+    time_start = perf_counter()
+    if options.render_direct:
+        pages = render_to_disk(pdf_file, file_path, start_count + first_page - 1, dpi, options, first_page, last_page)
+        _report_stage("rendered", pages)
+        _report_stage("encoded", pages)
+        return pages, perf_counter() - time_start, 0.0
+
+    images = convert_from_path(pdf_file, dpi=dpi, poppler_path=POPPLER_PATH,
+                               first_page=first_page, last_page=last_page)
+    time_rendered = perf_counter()
+    _report_stage("rendered", len(images))
+    for page, image in enumerate(images, start=first_page):
+        image_path = path.join(file_path, f"I{start_count + page - 1}.{options.extension}")
+        save_image(image, image_path, options)
+        image.close()
+        _report_stage("encoded", 1)
+    return len(images), time_rendered - time_start, perf_counter() - time_rendered
+
+# Stop a process pool now, killing its workers and the poppler processes they started
+def kill_pool(executor):
+    processes = list((getattr(executor, "_processes", None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        kill_process_tree(process.pid)
+
+def pdf_to_images_chunked(pdf_file, start_count=1, dpi=300, options=DEFAULT_OPTIONS, max_workers=None,
+                          chunk_size=CHUNK_SIZE, progress=None, output_path=None, on_pool=None,
+                          cancel_event=None, timeout=None, on_stage=None, total_pages=None):
+    """
+    Convert a PDF to images by rendering page ranges in a process pool.
+
+    Every worker renders and saves its own range, so only chunk_size pages per
+    worker are held in memory and poppler runs on all cores at once.
+
+    :param pdf_file: The PDF file path.
+    :param start_count: The starting index for naming images.
+    :param options: ImageOptions the pages are encoded with.
+    :param chunk_size: Number of pages rendered by a worker per task.
+    :param progress: Optional callable, called with the page count, render seconds and encode
+        seconds of every finished range.
+    :param output_path: Directory to save images, defaults to output_dir/<pdf name>.
+    :param on_pool: Optional callable, called with the ProcessPoolExecutor once it is created.
+    :param cancel_event: Optional threading.Event, setting it kills the workers and raises ConversionCancelled.
+    :param timeout: Optional wall clock limit in seconds, past it the workers are killed and
+        ConversionTimeout is raised.
+    :param on_stage: Optional callable, called with "rendered" or "encoded" and a page count as
+        the workers get pages through each stage, so progress shows before a range finishes.
+    :param total_pages: Page count of the PDF when the caller already read it.
+    :return: Total number of images created.
+    """
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()  # Use all available CPUs
+
+    file_path = output_path
+    if file_path is None:
+        file_name = path.basename(pdf_file).replace('.pdf', '')
+        file_path = path.join(output_dir, file_name)
+    makedirs(file_path, exist_ok=True)
+
+    deadline = perf_counter() + timeout if timeout else None
+    if total_pages is None:
+        total_pages = pdf_page_count(pdf_file, timeout or None)
+    ranges = page_ranges(total_pages, chunk_size)
+    total = 0
+    stages = multiprocessing.Queue() if on_stage is not None else None
+    with ProcessPoolExecutor(max_workers=min(max_workers, len(ranges)) or 1,
+                             initializer=_init_worker, initargs=(stages,)) as executor:
+        if on_pool is not None:
+            on_pool(executor)
+        futures = {executor.submit(render_page_range, pdf_file, file_path, first, last, start_count, dpi, options)
+                   for first, last in ranges}
+        while futures:
+            done, futures = wait(futures, timeout=CANCEL_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+            _drain_stages(stages, on_stage)
+            for future in done:
+                pages, render_time, encode_time = future.result()
+                total += pages
+                if progress is not None:
+                    progress(pages, render_time, encode_time)
+            if futures and cancel_event is not None and cancel_event.is_set():
+                kill_pool(executor)
+                raise ConversionCancelled(f"Conversion of {pdf_file} was cancelled")
+            if futures and deadline is not None and perf_counter() > deadline:
+                kill_pool(executor)
+                raise ConversionTimeout(f"Conversion of {pdf_file} took longer than {timeout} seconds")
+    # The workers have exited, whatever they reported is in the queue now
+    _drain_stages(stages, on_stage)
+    return total
+
 # import os
 # from os import path, makedirs
 # from pdf2image import convert_from_path
@@ -176,5 +494,6 @@ if __name__ == '__main__':
     if not path.exists(UPLOAD_DIRECTORY):
         makedirs(UPLOAD_DIRECTORY)
 
-    num_cpus = multiprocessing.cpu_count()
-    pdf_to_images_multiprocessing(pdfs, max_workers=num_cpus)
+    # One global numbering over every PDF, see batch.py for incremental per PDF folders
+    for result in pdfs_to_images_multiprocessing(pdfs, max_workers=NUM_CPUS):
+        print(result)